@@ -0,0 +1,200 @@
+import argparse
+import numpy as np
+
+from embedding_store import l2_normalize
+from config import (
+    FACE_MATCH_THRESHOLD,
+    ANN_INDEX_PATH,
+    ANN_NLIST,
+    ANN_NPROBE
+)
+
+ASSIGN_CHUNK_SIZE = 65536
+
+def assign_to_centroids(encodings, centroids, nprobe=1):
+    '''
+    encodings: numpy array of shape NxD of L2-normalised encodings.
+    centroids: numpy array of shape KxD of L2-normalised centroids.
+    nprobe: number of nearest centroids to be returned for each encoding.
+    Returns: Nxnprobe array of centroid indices sorted by decreasing similarity.
+    '''
+    nprobe = min(nprobe, len(centroids))
+    out = np.empty((len(encodings), nprobe), dtype=np.int64)
+    for start in range(0, len(encodings), ASSIGN_CHUNK_SIZE):
+        sims = encodings[start:start+ASSIGN_CHUNK_SIZE] @ centroids.T
+        if nprobe == 1:
+            out[start:start+len(sims), 0] = sims.argmax(axis=1)
+            continue
+        top = np.argpartition(-sims, nprobe-1, axis=1)[:, :nprobe]
+        order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+        out[start:start+len(sims)] = np.take_along_axis(top, order, axis=1)
+    return out
+
+
+def spherical_kmeans(encodings, k, iterations=20, seed=0):
+    '''
+    encodings: numpy array of shape NxD of L2-normalised encodings.
+    k: number of centroids.
+    iterations: number of Lloyd iterations.
+    seed: seed of random generator used for initialisation.
+    Returns: KxD array of L2-normalised centroids.
+    '''
+    rng = np.random.default_rng(seed)
+    centroids = encodings[rng.choice(len(encodings), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign_to_centroids(encodings, centroids)[:, 0]
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=k)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        sums = np.zeros_like(centroids)
+        nonempty = np.where(counts > 0)[0]
+        sums[nonempty] = np.add.reduceat(encodings[order], starts[nonempty], axis=0)
+        # Re-seed empty clusters with random encodings.
+        empty = np.where(counts == 0)[0]
+        sums[empty] = encodings[rng.choice(len(encodings), len(empty), replace=False)]
+        centroids = l2_normalize(sums)
+    return centroids
+
+
+class IVFIndex(object):
+    '''
+    Inverted file index over L2-normalised face encodings.
+    Encodings are clustered around nlist coarse centroids and the index
+    keeps only their row numbers grouped per cluster. A query only scores
+    the clusters of its nprobe nearest centroids, reading their rows from
+    the gallery encodings, which are usually memory-mapped from EmbeddingStore.
+    '''
+    def __init__(self, centroids, ids, rows, offsets, encodings=None):
+        '''
+        centroids: numpy array of shape KxD.
+        ids: array of N person ids in gallery row order.
+        rows: array of N gallery row numbers ordered by cluster.
+        offsets: array of K+1 offsets, cluster c owns rows[offsets[c]:offsets[c+1]].
+        encodings: NxD gallery encodings the rows refer to.
+        '''
+        self.centroids = centroids
+        self.ids = np.asarray(ids, dtype=object)
+        self.rows = rows
+        self.offsets = offsets
+        self.encodings = encodings
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, ids, encodings, nlist, iterations=20, max_train_size=None, seed=0):
+        '''
+        ids: list of N person ids.
+        encodings: numpy array of shape NxD of L2-normalised encodings, it
+                    is kept by the index and read again on every search.
+        nlist: number of coarse centroids, about sqrt(N) is a good start.
+        iterations: number of k-means iterations.
+        max_train_size: number of encodings sampled for k-means,
+                        defaults to 256 per centroid.
+        seed: seed of random generator.
+        Returns: IVFIndex containing all encodings.
+        '''
+        nlist = max(1, min(nlist, len(encodings)))
+        if max_train_size is None:
+            max_train_size = 256*nlist
+        rng = np.random.default_rng(seed)
+        train = np.asarray(encodings, dtype=np.float32)
+        if len(encodings) > max_train_size:
+            train = np.asarray(encodings[np.sort(rng.choice(len(encodings), max_train_size, replace=False))], dtype=np.float32)
+        centroids = spherical_kmeans(train, nlist, iterations, seed)
+        assignment = assign_to_centroids(encodings, centroids)[:, 0]
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(nlist+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=nlist))
+        return cls(centroids, ids, order, offsets, encodings)
+
+    def _probe(self, query, nprobe):
+        '''
+        Returns: (rows, scores) of encodings in clusters probed by query.
+        '''
+        lists = assign_to_centroids(query[np.newaxis], self.centroids, nprobe)[0]
+        rows = np.concatenate([self.rows[self.offsets[c]:self.offsets[c+1]] for c in lists])
+        # Rows of a cluster are ascending, which keeps memory-mapped reads sequential.
+        scores = np.asarray(self.encodings[rows], dtype=np.float32) @ query
+        return rows, scores
+
+    def search(self, encodings, threshold=FACE_MATCH_THRESHOLD, nprobe=ANN_NPROBE, check=None):
+        '''
+        encodings: numpy array of shape D or QxD of query face encodings.
+        threshold: minimum cosine similarity for a person to be matched.
+        nprobe: number of clusters scored per query, higher is slower and more exact.
+        check: function called between queries which raises to stop search.
+        Returns: list of Q lists of matched person ids sorted by decreasing similarity.
+        '''
+        if self.encodings is None:
+            raise ValueError("gallery encodings are required for search")
+        queries = l2_normalize(encodings).reshape(-1, self.centroids.shape[1])
+        results = []
+        for query in queries:
+            if check is not None:
+                check()
+            rows, scores = self._probe(query, nprobe)
+            keep = np.where(scores >= threshold)[0]
+            keep = keep[np.argsort(scores[keep])[::-1]]
+            results.append(self.ids[rows[keep]].tolist())
+        return results
+
+    def search_knn(self, encodings, k, nprobe=ANN_NPROBE):
+        '''
+        encodings: numpy array of shape D or QxD of query face encodings.
+        k: number of neighbours to be returned.
+        nprobe: number of clusters scored per query.
+        Returns: list of Q lists of at most k person ids sorted by decreasing similarity.
+        '''
+        queries = l2_normalize(encodings).reshape(-1, self.centroids.shape[1])
+        results = []
+        for query in queries:
+            rows, scores = self._probe(query, nprobe)
+            top = np.argsort(scores)[::-1][:k]
+            results.append(self.ids[rows[top]].tolist())
+        return results
+
+    def save(self, path):
+        '''
+        path: .npz file to which index is written.
+        '''
+        np.savez(
+            path,
+            centroids=self.centroids,
+            ids=self.ids.astype(str),
+            rows=self.rows,
+            offsets=self.offsets
+        )
+
+    @classmethod
+    def load(cls, path, encodings):
+        '''
+        path: .npz file written by save().
+        encodings: NxD gallery encodings the index was built over.
+        Returns: IVFIndex instance.
+        '''
+        with np.load(path) as data:
+            return cls(
+                data["centroids"],
+                data["ids"].astype(object),
+                data["rows"],
+                data["offsets"],
+                encodings
+            )
+
+
+if __name__ == "__main__":
+    from gallery import get_gallery
+    parser = argparse.ArgumentParser(description="Build IVF index over current gallery")
+    parser.add_argument("--nlist", default=ANN_NLIST, type=int)
+    parser.add_argument("--iterations", default=20, type=int)
+    parser.add_argument("--index_path", default=ANN_INDEX_PATH)
+    args = parser.parse_args()
+    gallery = get_gallery()
+    index = IVFIndex.build(gallery.ids, gallery.encodings, args.nlist, args.iterations)
+    index.save(args.index_path)
+    print("Indexed {} encodings in {} lists to {}".format(len(index), index.nlist, args.index_path))
@@ -0,0 +1,88 @@
+import json
+
+from PIL import UnidentifiedImageError
+
+from utils import read_image_from_bytes, get_content_hash
+from cache_utils import LRUCache
+from config import (
+    MAX_IMAGE_BYTES,
+    IMAGE_CACHE_MAX_BYTES,
+    IMAGE_CACHE_TTL
+)
+
+# Request handling shared by app.py and asgi_app.py, so that both servers
+# decode, cache and validate uploads in the same way.
+
+# Decoded images and their detected bboxes keyed by (identity, image handle).
+image_cache = LRUCache(IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_TTL)
+
+
+def get_cached_image(identity, image_handle):
+    '''
+    identity: username of caller, images are cached per user so that a
+                handle is only usable by the user who uploaded the image.
+    image_handle: content hash of image.
+    Returns: cache entry with keys img and bboxes or None if not cached.
+    '''
+    return image_cache.get((identity, image_handle))
+
+
+def load_image(identity, image_bytes):
+    '''
+    identity: username of caller.
+    image_bytes: encoded image file contents.
+    Decodes image unless an image with same contents is already cached.
+    Returns: (image_handle, cache entry with keys img and bboxes, None)
+            or (None, None, error status) where error status is image_too_large
+            or invalid_image if image could not be decoded.
+    '''
+    if len(image_bytes) > MAX_IMAGE_BYTES:
+        return None, None, "image_too_large"
+    image_handle = get_content_hash(image_bytes)
+    entry = image_cache.get((identity, image_handle))
+    if entry is None:
+        try:
+            img = read_image_from_bytes(image_bytes)
+        except (UnidentifiedImageError, OSError, ValueError):
+            return None, None, "invalid_image"
+        if img is None:
+            return None, None, "image_too_large"
+        entry = {"img": img, "bboxes": None}
+        image_cache.put((identity, image_handle), entry, img.nbytes)
+    return image_handle, entry, None
+
+
+def parse_bboxes(value):
+    '''
+    value: JSON encoded list of bboxes from a form field or query string.
+    Returns: list of bboxes or None if value is missing or not valid JSON.
+    '''
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_flag(value):
+    '''
+    value: form field or query string value.
+    Returns: True if value is "1" or "true".
+    '''
+    return value is not None and value.lower() in ("1", "true")
+
+
+def is_valid_cursor(cursor):
+    '''
+    cursor: number of bbox results already received by client.
+    Returns: True if cursor is a non-negative integer.
+    '''
+    return isinstance(cursor, int) and not isinstance(cursor, bool) and cursor >= 0
+
+
+def format_event(event, data):
+    '''
+    event: name of server-sent event.
+    data: JSON serialisable data of event.
+    Returns: event encoded in text/event-stream format.
+    '''
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
@@ -5,7 +5,9 @@ from flask import (
     Flask, 
     request, 
     jsonify, 
-    send_from_directory
+    send_from_directory, 
+    Response, 
+    stream_with_context
 )
 
 from flask_jwt_extended import (
@@ -22,34 +24,49 @@ from flask_jwt_extended import (
 from utils import (
     verify_data, 
     verify_file_extension, 
-    read_image, 
+    decode_base64, 
     encode_to_base64, 
-    decode_from_base64, 
-    get_unique_id, 
     get_system_info, 
     get_person_data
 )
 
 from model_utils import (
-    detect_faces, 
+    detect_faces_scheduled, 
     encode_face, 
-    search_matching_faces
+    search_matching_faces, 
+    identify_faces, 
+    estimate_task_cost
 )
 
 from concurrency_utils import (
-    pool, 
-    mp_progress_dict, 
-    mp_result_dict, 
+    submit_task, 
     get_progress, 
+    get_eta, 
+    get_queue_position, 
+    get_partial_result, 
+    get_partial_count, 
+    cancel_task, 
+    is_task_cancelled, 
     get_result, 
+    TaskFailed, 
+    get_incremental_result, 
+    wait_task, 
     delete_task, 
-    get_total_tasks
+    get_total_tasks, 
+    get_evicted_tasks, 
+    get_worker_report, 
+    get_embedding_cache_stats, 
+    print_worker_report, 
+    init_pool
 )
 
 from config import (
     PERSON_DATA_PATH, 
     FACE_IMAGE_PATH, 
-    STARRED_PERSON_COUNT_LIMIT
+    STARRED_PERSON_COUNT_LIMIT, 
+    MAX_IMAGE_BYTES, 
+    MAX_REQUEST_BYTES, 
+    STREAM_POLL_INTERVAL
 )
 
 from db.utils import (
@@ -62,6 +79,15 @@ from db.utils import (
     get_starred_persons
 )
 
+from api_utils import (
+    get_cached_image, 
+    load_image, 
+    parse_bboxes, 
+    parse_flag, 
+    is_valid_cursor, 
+    format_event
+)
+
 from blacklist import blacklist
 
 with open(os.path.join("docs", "secret_key.txt"), "r") as f:
@@ -74,15 +100,25 @@ response_messages = api_format["response_messages"]
 
 app = Flask(__name__)
 
-app.config["JWT_TOKEN_LOCATION"] = "json"
+app.config["JWT_TOKEN_LOCATION"] = ["json", "headers"] # Binary uploads send "Authorization: Bearer <access_token>"
 app.config["JWT_SECRET_KEY"] = secret_key
 app.config["JWT_JSON_KEY"] = "access_token" # Key to look for access token in JSON
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = 2592000
 app.config["JWT_BLACKLIST_ENABLED"] = True # Enable/Disable token revoking
 app.config["JWT_BLACKLIST_TOKEN_CHECKS"] = "access" # What token types to check against the blacklist.
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES # Bounds multipart and chunked bodies before they are parsed
 
 jwt = JWTManager(app)
 
+@app.errorhandler(413)
+def request_too_large_callback(error):
+    resp = {
+        "status_code": status_codes["image_too_large"], 
+        "message": response_messages["image_too_large"]
+    }
+    return jsonify(resp)
+
+
 @jwt.unauthorized_loader
 def unauthorized_callback(msg):
     resp = {
@@ -194,7 +230,10 @@ def root_callback():
         "status_code": status_codes["success"], 
         "message": response_messages["success"], 
         "total_tasks": total_tasks, 
-        "completed_tasks": completed_tasks
+        "completed_tasks": completed_tasks, 
+        "evicted_tasks": get_evicted_tasks(), 
+        "workers": get_worker_report(), 
+        "embedding_cache": get_embedding_cache_stats()
     }
     for k, v in info.items():
         resp[k] = v
@@ -257,6 +296,22 @@ def get_person_data_callback():
     return jsonify(resp)
 
 
+def read_binary_upload():
+    '''
+    Reads image sent as multipart file field "image" or as raw 
+    application/octet-stream body with image_name in query string.
+    At most MAX_IMAGE_BYTES + 1 bytes are read, so that a chunked upload 
+    without Content-Length is still bounded and found too large by load_image.
+    Returns: (image_name, image_bytes) or (None, None) if no image is found.
+    '''
+    if "image" in request.files:
+        f = request.files["image"]
+        return f.filename, f.read(MAX_IMAGE_BYTES + 1)
+    if request.mimetype == "application/octet-stream":
+        return request.args.get("image_name"), request.stream.read(MAX_IMAGE_BYTES + 1)
+    return None, None
+
+
 @app.route("/detect-faces", methods=["POST"])
 @jwt_required
 def detect_faces_callback():
@@ -273,15 +328,21 @@ def detect_faces_callback():
             "message": response_messages["file_extension_error"]
         }
         return jsonify(resp)
-    temp_img_name = get_unique_id() + "." + data["image_name"].split(".")[-1]
-    temp_img_path = os.path.join("temp", temp_img_name)
-    decode_from_base64(data["image_data"], temp_img_path)
-    img = read_image(temp_img_path)
-    bboxes = detect_faces(img)
+    image_bytes = decode_base64(data["image_data"])
+    image_handle, entry, error = load_image(get_jwt_identity(), image_bytes) if image_bytes is not None else (None, None, "image_too_large")
+    if error is not None:
+        resp = {
+            "status_code": status_codes[error], 
+            "message": response_messages[error]
+        }
+        return jsonify(resp)
+    if entry["bboxes"] is None:
+        entry["bboxes"] = detect_faces_scheduled(entry["img"])
     resp = {
         "status_code": status_codes["success"], 
         "message": response_messages["success"], 
-        "bboxes": bboxes
+        "bboxes": entry["bboxes"], 
+        "image_handle": image_handle
     }
     return jsonify(resp)
 
@@ -290,27 +351,209 @@ def detect_faces_callback():
 @jwt_required
 def search_matching_faces_callback():
     data = request.get_json()
-    if not verify_data(data, "image_data", "image_name", "bboxes"):
+    if verify_data(data, "image_handle", "bboxes"):
+        image_handle = data["image_handle"]
+        entry = get_cached_image(get_jwt_identity(), image_handle)
+        if entry is None:
+            resp = {
+                "status_code": status_codes["image_handle_not_found"], 
+                "message": response_messages["image_handle_not_found"]
+            }
+            return jsonify(resp)
+    else:
+        if not verify_data(data, "image_data", "image_name", "bboxes"):
+            resp = {
+                "status_code": status_codes["insufficient_data"], 
+                "message": response_messages["insufficient_data"]
+            }
+            return jsonify(resp)
+        if not verify_file_extension(data["image_name"]):
+            resp = {
+                "status_code": status_codes["file_extension_error"], 
+                "message": response_messages["file_extension_error"]
+            }
+            return jsonify(resp)
+        image_bytes = decode_base64(data["image_data"])
+        image_handle, entry, error = load_image(get_jwt_identity(), image_bytes) if image_bytes is not None else (None, None, "image_too_large")
+        if error is not None:
+            resp = {
+                "status_code": status_codes[error], 
+                "message": response_messages[error]
+            }
+            return jsonify(resp)
+    img = entry["img"]
+    bboxes = data["bboxes"]
+    token = submit_task(
+        search_matching_faces, img, bboxes, image_hash=image_handle, starred_first=bool(data.get("starred_first", False)), 
+        user=get_jwt_identity(), priority=data.get("priority"), cost=estimate_task_cost(bboxes)
+    )
+    if token is None:
         resp = {
-            "status_code": status_codes["insufficient_data"], 
-            "message": response_messages["insufficient_data"]
+            "status_code": status_codes["too_many_tasks"], 
+            "message": response_messages["too_many_tasks"]
         }
         return jsonify(resp)
-    if not verify_file_extension(data["image_name"]):
+    resp = {
+        "status_code": status_codes["success"], 
+        "message": response_messages["success"], 
+        "token": token
+    }
+    return jsonify(resp)
+
+
+@app.route("/detect-faces-binary", methods=["POST"])
+@jwt_required
+def detect_faces_binary_callback():
+    if request.content_length is not None and request.content_length > MAX_IMAGE_BYTES:
+        resp = {
+            "status_code": status_codes["image_too_large"], 
+            "message": response_messages["image_too_large"]
+        }
+        return jsonify(resp)
+    image_name, image_bytes = read_binary_upload()
+    if image_bytes is None:
+        resp = {
+            "status_code": status_codes["file_not_found_in_request"], 
+            "message": response_messages["file_not_found_in_request"]
+        }
+        return jsonify(resp)
+    if image_name is None or not verify_file_extension(image_name):
         resp = {
             "status_code": status_codes["file_extension_error"], 
             "message": response_messages["file_extension_error"]
         }
         return jsonify(resp)
-    temp_img_name = get_unique_id() + "." + data["image_name"].split(".")[-1]
-    temp_img_path = os.path.join("temp", temp_img_name)
-    decode_from_base64(data["image_data"], temp_img_path)
-    img = read_image(temp_img_path)
-    bboxes = data["bboxes"]
-    token = get_unique_id()
-    mp_progress_dict[token] = 0.0
-    proc = pool.apply_async(search_matching_faces, (img, bboxes, token, mp_progress_dict))
-    mp_result_dict[token] = proc
+    image_handle, entry, error = load_image(get_jwt_identity(), image_bytes)
+    if error is not None:
+        resp = {
+            "status_code": status_codes[error], 
+            "message": response_messages[error]
+        }
+        return jsonify(resp)
+    if entry["bboxes"] is None:
+        entry["bboxes"] = detect_faces_scheduled(entry["img"])
+    resp = {
+        "status_code": status_codes["success"], 
+        "message": response_messages["success"], 
+        "bboxes": entry["bboxes"], 
+        "image_handle": image_handle
+    }
+    return jsonify(resp)
+
+
+@app.route("/search-matching-faces-binary", methods=["POST"])
+@jwt_required
+def search_matching_faces_binary_callback():
+    if request.content_length is not None and request.content_length > MAX_IMAGE_BYTES:
+        resp = {
+            "status_code": status_codes["image_too_large"], 
+            "message": response_messages["image_too_large"]
+        }
+        return jsonify(resp)
+    bboxes = parse_bboxes(request.form.get("bboxes", request.args.get("bboxes")))
+    if bboxes is None:
+        resp = {
+            "status_code": status_codes["insufficient_data"], 
+            "message": response_messages["insufficient_data"]
+        }
+        return jsonify(resp)
+    image_handle = request.form.get("image_handle", request.args.get("image_handle"))
+    if image_handle is not None:
+        entry = get_cached_image(get_jwt_identity(), image_handle)
+        if entry is None:
+            resp = {
+                "status_code": status_codes["image_handle_not_found"], 
+                "message": response_messages["image_handle_not_found"]
+            }
+            return jsonify(resp)
+    else:
+        image_name, image_bytes = read_binary_upload()
+        if image_bytes is None:
+            resp = {
+                "status_code": status_codes["file_not_found_in_request"], 
+                "message": response_messages["file_not_found_in_request"]
+            }
+            return jsonify(resp)
+        if image_name is None or not verify_file_extension(image_name):
+            resp = {
+                "status_code": status_codes["file_extension_error"], 
+                "message": response_messages["file_extension_error"]
+            }
+            return jsonify(resp)
+        image_handle, entry, error = load_image(get_jwt_identity(), image_bytes)
+        if error is not None:
+            resp = {
+                "status_code": status_codes[error], 
+                "message": response_messages[error]
+            }
+            return jsonify(resp)
+    img = entry["img"]
+    priority = request.form.get("priority", request.args.get("priority"))
+    starred_first = parse_flag(request.form.get("starred_first", request.args.get("starred_first")))
+    token = submit_task(
+        search_matching_faces, img, bboxes, image_hash=image_handle, starred_first=starred_first, 
+        user=get_jwt_identity(), priority=priority, cost=estimate_task_cost(bboxes)
+    )
+    if token is None:
+        resp = {
+            "status_code": status_codes["too_many_tasks"], 
+            "message": response_messages["too_many_tasks"]
+        }
+        return jsonify(resp)
+    resp = {
+        "status_code": status_codes["success"], 
+        "message": response_messages["success"], 
+        "token": token
+    }
+    return jsonify(resp)
+
+
+@app.route("/identify-faces", methods=["POST"])
+@jwt_required
+def identify_faces_callback():
+    data = request.get_json()
+    if verify_data(data, "image_handle"):
+        image_handle = data["image_handle"]
+        entry = get_cached_image(get_jwt_identity(), image_handle)
+        if entry is None:
+            resp = {
+                "status_code": status_codes["image_handle_not_found"], 
+                "message": response_messages["image_handle_not_found"]
+            }
+            return jsonify(resp)
+    else:
+        if not verify_data(data, "image_data", "image_name"):
+            resp = {
+                "status_code": status_codes["insufficient_data"], 
+                "message": response_messages["insufficient_data"]
+            }
+            return jsonify(resp)
+        if not verify_file_extension(data["image_name"]):
+            resp = {
+                "status_code": status_codes["file_extension_error"], 
+                "message": response_messages["file_extension_error"]
+            }
+            return jsonify(resp)
+        image_bytes = decode_base64(data["image_data"])
+        image_handle, entry, error = load_image(get_jwt_identity(), image_bytes) if image_bytes is not None else (None, None, "image_too_large")
+        if error is not None:
+            resp = {
+                "status_code": status_codes[error], 
+                "message": response_messages[error]
+            }
+            return jsonify(resp)
+    overlapped = bool(data.get("overlapped", False))
+    token = submit_task(
+        identify_faces, entry["img"], image_hash=image_handle, bboxes=entry["bboxes"], overlapped=overlapped, 
+        starred_first=bool(data.get("starred_first", False)), 
+        user=get_jwt_identity(), priority=data.get("priority"), cost=estimate_task_cost(entry["bboxes"])
+    )
+    if token is None:
+        resp = {
+            "status_code": status_codes["too_many_tasks"], 
+            "message": response_messages["too_many_tasks"]
+        }
+        return jsonify(resp)
     resp = {
         "status_code": status_codes["success"], 
         "message": response_messages["success"], 
@@ -336,10 +579,123 @@ def get_task_progress_callback():
             "message": response_messages["task_not_found"]
         }
         return jsonify(resp)
+    if is_task_cancelled(data["token"]):
+        resp = {
+            "status_code": status_codes["task_cancelled"], 
+            "message": response_messages["task_cancelled"]
+        }
+        return jsonify(resp)
+    resp = {
+        "status_code": status_codes["success"], 
+        "message": response_messages["success"], 
+        "progress": progress, 
+        "eta": get_eta(data["token"]), 
+        "queue_position": get_queue_position(data["token"]), 
+        "partial_result": get_partial_result(data["token"])
+    }
+    return jsonify(resp)
+
+
+@app.route("/stream-task-progress", methods=["POST"])
+@jwt_required
+def stream_task_progress_callback():
+    data = request.get_json()
+    if not verify_data(data, "token"):
+        resp = {
+            "status_code": status_codes["insufficient_data"], 
+            "message": response_messages["insufficient_data"]
+        }
+        return jsonify(resp)
+    token = data["token"]
+    if get_progress(token) is None:
+        resp = {
+            "status_code": status_codes["task_not_found"], 
+            "message": response_messages["task_not_found"]
+        }
+        return jsonify(resp)
+
+    def generate():
+        last_state = None
+        last_partial_count = 0
+        while True:
+            # Waiting on the task itself needs no polling, progress is 
+            # read at most once per STREAM_POLL_INTERVAL.
+            completed = wait_task(token, STREAM_POLL_INTERVAL)
+            progress = get_progress(token)
+            if completed is None or progress is None:
+                yield format_event("error", {
+                    "status_code": status_codes["task_not_found"], 
+                    "message": response_messages["task_not_found"]
+                })
+                return
+            if is_task_cancelled(token):
+                yield format_event("error", {
+                    "status_code": status_codes["task_cancelled"], 
+                    "message": response_messages["task_cancelled"]
+                })
+                return
+            state = (progress, get_queue_position(token))
+            if state != last_state:
+                last_state = state
+                yield format_event("progress", {"progress": progress, "eta": get_eta(token), "queue_position": state[1]})
+            partial_count = get_partial_count(token)
+            if partial_count != last_partial_count and not completed:
+                last_partial_count = partial_count
+                yield format_event("partial", {"partial_result": get_partial_result(token)})
+            if completed:
+                try:
+                    result = get_result(token)
+                except TaskFailed:
+                    status = "task_cancelled" if is_task_cancelled(token) else "task_failed"
+                    yield format_event("error", {
+                        "status_code": status_codes[status], 
+                        "message": response_messages[status]
+                    })
+                    return
+                yield format_event("result", {
+                    "status_code": status_codes["success"], 
+                    "message": response_messages["success"], 
+                    "result": result
+                })
+                return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=headers)
+
+
+def get_incremental_result_response(token, cursor):
+    '''
+    token: unique process token generated when creating process.
+    cursor: number of bbox results already received by client.
+    Returns: response holding results of bboxes completed after cursor and next cursor.
+    '''
+    if not is_valid_cursor(cursor):
+        resp = {
+            "status_code": status_codes["invalid_cursor"], 
+            "message": response_messages["invalid_cursor"]
+        }
+        return jsonify(resp)
+    incremental = get_incremental_result(token, cursor)
+    if incremental is None:
+        resp = {
+            "status_code": status_codes["task_not_found"], 
+            "message": response_messages["task_not_found"]
+        }
+        return jsonify(resp)
+    if incremental is False:
+        status = "task_cancelled" if is_task_cancelled(token) else "task_failed"
+        resp = {
+            "status_code": status_codes[status], 
+            "message": response_messages[status]
+        }
+        return jsonify(resp)
+    results, cursor, completed = incremental
     resp = {
         "status_code": status_codes["success"], 
         "message": response_messages["success"], 
-        "progress": progress
+        "result": results, 
+        "cursor": cursor, 
+        "completed": completed
     }
     return jsonify(resp)
 
@@ -354,7 +710,23 @@ def get_task_result_callback():
             "message": response_messages["insufficient_data"]
         }
         return jsonify(resp)
-    result = get_result(data["token"])
+    if is_task_cancelled(data["token"]):
+        resp = {
+            "status_code": status_codes["task_cancelled"], 
+            "message": response_messages["task_cancelled"]
+        }
+        return jsonify(resp)
+    if "cursor" in data:
+        return get_incremental_result_response(data["token"], data["cursor"])
+    try:
+        result = get_result(data["token"])
+    except TaskFailed:
+        status = "task_cancelled" if is_task_cancelled(data["token"]) else "task_failed"
+        resp = {
+            "status_code": status_codes[status], 
+            "message": response_messages[status]
+        }
+        return jsonify(resp)
     if result is None:
         resp = {
             "status_code": status_codes["task_not_found"], 
@@ -377,6 +749,31 @@ def get_task_result_callback():
     return jsonify(resp)
 
 
+@app.route("/cancel-task", methods=["POST"])
+@jwt_required
+def cancel_task_callback():
+    data = request.get_json()
+    if not verify_data(data, "token"):
+        resp = {
+            "status_code": status_codes["insufficient_data"], 
+            "message": response_messages["insufficient_data"]
+        }
+        return jsonify(resp)
+    cancelled = cancel_task(data["token"])
+    if cancelled is None:
+        resp = {
+            "status_code": status_codes["task_not_found"], 
+            "message": response_messages["task_not_found"]
+        }
+        return jsonify(resp)
+    resp = {
+        "status_code": status_codes["success"], 
+        "message": response_messages["success"], 
+        "result": cancelled
+    }
+    return jsonify(resp)
+
+
 @app.route("/search-person", methods=["POST"])
 @jwt_required
 def search_person_callback():
@@ -465,7 +862,11 @@ def get_starred_persons_callback():
     return jsonify(resp)
 
 if __name__ == "__main__":
+    # Pool is started here and not at import, spawned workers import this module as __mp_main__.
+    # Reloader is off so that __main__ runs once and only one inference pool is started.
+    init_pool()
+    print_worker_report()
     try:
-        app.run(host="0.0.0.0", port=8080, debug=True)
+        app.run(host="0.0.0.0", port=8080, debug=True, use_reloader=False)
     except KeyboardInterrupt as e:
         print("Keyboard interrupt. Stopping server")
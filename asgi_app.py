@@ -0,0 +1,628 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import jwt
+from starlette.applications import Starlette
+from starlette.datastructures import FormData
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from utils import (
+    verify_data,
+    verify_file_extension,
+    decode_base64,
+    encode_to_base64,
+    get_system_info,
+    get_person_data
+)
+
+from model_utils import (
+    detect_faces_scheduled,
+    search_matching_faces,
+    identify_faces,
+    estimate_task_cost
+)
+
+from concurrency_utils import (
+    init_pool,
+    submit_task,
+    get_progress,
+    get_eta,
+    get_queue_position,
+    get_partial_result,
+    get_partial_count,
+    cancel_task,
+    is_task_cancelled,
+    get_result,
+    TaskFailed,
+    get_incremental_result,
+    wait_task,
+    get_total_tasks,
+    get_evicted_tasks,
+    get_worker_report,
+    get_embedding_cache_stats,
+    print_worker_report
+)
+
+from config import (
+    PERSON_DATA_PATH,
+    FACE_IMAGE_PATH,
+    STARRED_PERSON_COUNT_LIMIT,
+    MAX_IMAGE_BYTES,
+    MAX_REQUEST_BYTES,
+    STREAM_POLL_INTERVAL,
+    DETECT_EXECUTOR_THREADS
+)
+
+from db.utils import (
+    get_person_data_from_database,
+    search_person_by_name,
+    auth_user,
+    add_star_to_person,
+    remove_star_from_person,
+    get_starred_persons
+)
+
+from api_utils import (
+    get_cached_image,
+    load_image,
+    parse_bboxes,
+    parse_flag,
+    is_valid_cursor,
+    format_event
+)
+
+from blacklist import blacklist
+
+# Asyncio serving mode of app.py with same routes, tokens and status codes.
+# uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+
+with open(os.path.join("docs", "secret_key.txt"), "r") as f:
+    secret_key = f.readline()
+
+with open(os.path.join("docs", "api_format.json"), "r") as f:
+    api_format = json.load(f)
+status_codes = api_format["status_codes"]
+response_messages = api_format["response_messages"]
+
+# Same token format as flask_jwt_extended so tokens work with both servers.
+JWT_ALGORITHM = "HS256"
+JWT_JSON_KEY = "access_token"
+JWT_IDENTITY_CLAIM = "identity"
+JWT_ACCESS_TOKEN_EXPIRES = 2592000
+
+# Images are decoded and detected in server threads as in app.py, on their own 
+# executor so that they never queue behind search tasks of inference pool.
+detect_executor = ThreadPoolExecutor(DETECT_EXECUTOR_THREADS)
+
+
+def make_response(status, **fields):
+    '''
+    status: key of status_codes and response_messages.
+    fields: additional fields of response.
+    Returns: JSONResponse with status_code, message and fields.
+    '''
+    resp = {
+        "status_code": status_codes[status],
+        "message": response_messages[status]
+    }
+    resp.update(fields)
+    return JSONResponse(resp)
+
+
+def run_in_detect_executor(func, *args):
+    '''
+    func: function run in detect_executor.
+    Returns: asyncio future resolved with result of func without blocking event loop.
+    '''
+    return asyncio.get_running_loop().run_in_executor(detect_executor, func, *args)
+
+
+def create_access_token(identity, fresh=False):
+    '''
+    identity: username of token owner.
+    fresh: True if token is created from password.
+    Returns: encoded access token.
+    '''
+    now = int(time.time())
+    claims = {
+        "iat": now,
+        "nbf": now,
+        "jti": str(uuid.uuid4()),
+        "exp": now + JWT_ACCESS_TOKEN_EXPIRES,
+        JWT_IDENTITY_CLAIM: identity,
+        "fresh": fresh,
+        "type": "access"
+    }
+    token = jwt.encode(claims, secret_key, algorithm=JWT_ALGORITHM)
+    # PyJWT < 2 returns bytes.
+    return token.decode("utf-8") if isinstance(token, bytes) else token
+
+
+async def read_json(request):
+    '''
+    Returns: JSON body of request or None if request is not JSON.
+    '''
+    if request.headers.get("content-type", "").split(";")[0].strip() != "application/json":
+        return None
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def jwt_required(handler):
+    '''
+    Decorator verifying access token sent in JSON body or Authorization header.
+    Decorated handler is called with request and its JSON body.
+    '''
+    async def wrapper(request):
+        data = await read_json(request)
+        token = None
+        if isinstance(data, dict) and data.get(JWT_JSON_KEY):
+            token = data[JWT_JSON_KEY]
+        elif request.headers.get("authorization", "").startswith("Bearer "):
+            token = request.headers["authorization"][len("Bearer "):]
+        if token is None:
+            return make_response("unauthorized_loader")
+        try:
+            claims = jwt.decode(token, secret_key, algorithms=[JWT_ALGORITHM])
+        except jwt.ExpiredSignatureError:
+            return make_response("expired_token_loader")
+        except jwt.InvalidTokenError:
+            return make_response("invalid_token_loader")
+        if claims.get("type") != "access" or JWT_IDENTITY_CLAIM not in claims:
+            return make_response("invalid_token_loader")
+        if claims[JWT_IDENTITY_CLAIM] in blacklist:
+            return make_response("revoked_token_loader")
+        request.state.identity = claims[JWT_IDENTITY_CLAIM]
+        return await handler(request, data)
+    return wrapper
+
+
+async def login_callback(request):
+    data = await read_json(request)
+    if not verify_data(data, "username", "password"):
+        return make_response("insufficient_data")
+    if not await asyncio.to_thread(auth_user, data["username"], data["password"]):
+        return make_response("invalid_credentials")
+    return make_response("success", access_token=create_access_token(data["username"], fresh=True))
+
+
+@jwt_required
+async def get_fresh_token_callback(request, data):
+    if not verify_data(data, "password"):
+        return make_response("insufficient_data")
+    identity = request.state.identity
+    if not await asyncio.to_thread(auth_user, identity, data["password"]):
+        return make_response("invalid_credentials")
+    return make_response("success", access_token=create_access_token(identity, fresh=True))
+
+
+@jwt_required
+async def root_callback(request, data):
+    info = await asyncio.to_thread(get_system_info)
+    total_tasks, completed_tasks = get_total_tasks()
+    return make_response(
+        "success",
+        total_tasks=total_tasks,
+        completed_tasks=completed_tasks,
+        evicted_tasks=get_evicted_tasks(),
+        workers=await asyncio.to_thread(get_worker_report),
+        embedding_cache=await asyncio.to_thread(get_embedding_cache_stats),
+        **info
+    )
+
+
+@jwt_required
+async def get_face_image_callback(request, data):
+    if not verify_data(data, "image_name"):
+        return make_response("insufficient_data")
+    img_dir = os.path.join(FACE_IMAGE_PATH, data["image_name"])
+    if not os.path.exists(img_dir):
+        return make_response("image_not_found")
+    return make_response("success", image_data=await asyncio.to_thread(encode_to_base64, img_dir))
+
+
+def read_person_data(id):
+    '''
+    id: id of person.
+    Returns: person data with star and base64 encoded image.
+    '''
+    d_json = get_person_data(id)
+    temp = get_person_data_from_database(id)
+    if temp is not None:
+        d_json["star"] = temp["star"]
+    d_json["image"] = encode_to_base64(os.path.join(FACE_IMAGE_PATH, d_json["image"]))
+    return d_json
+
+
+def read_persons(persons):
+    '''
+    persons: list of person (id, star).
+    Returns: list of person data with star and base64 encoded image.
+    '''
+    result = []
+    for mid, star in persons:
+        json_d = get_person_data(mid)
+        json_d["star"] = star
+        json_d["image"] = encode_to_base64(os.path.join(FACE_IMAGE_PATH, json_d["image"]))
+        result.append(json_d)
+    return result
+
+
+@jwt_required
+async def get_person_data_callback(request, data):
+    if not verify_data(data, "id"):
+        return make_response("insufficient_data")
+    if not os.path.exists(os.path.join(PERSON_DATA_PATH, data["id"]+".json")):
+        return make_response("person_not_found")
+    return make_response("success", data=await asyncio.to_thread(read_person_data, data["id"]))
+
+
+async def load_json_image(identity, data):
+    '''
+    identity: username of caller.
+    data: JSON body holding image_name and image_data or image_handle.
+    Returns: (image_handle, cache entry, None) or (None, None, error response).
+    '''
+    if verify_data(data, "image_handle"):
+        entry = get_cached_image(identity, data["image_handle"])
+        if entry is None:
+            return None, None, make_response("image_handle_not_found")
+        return data["image_handle"], entry, None
+    if not verify_data(data, "image_data", "image_name"):
+        return None, None, make_response("insufficient_data")
+    if not verify_file_extension(data["image_name"]):
+        return None, None, make_response("file_extension_error")
+    image_bytes = await asyncio.to_thread(decode_base64, data["image_data"])
+    if image_bytes is None:
+        return None, None, make_response("image_too_large")
+    image_handle, entry, error = await run_in_detect_executor(load_image, identity, image_bytes)
+    if error is not None:
+        return None, None, make_response(error)
+    return image_handle, entry, None
+
+
+async def read_body(request, max_bytes):
+    '''
+    max_bytes: maximum number of bytes read from body.
+    Reads body as it streams in, so that a chunked upload without 
+    Content-Length does not make it be read into memory as a whole.
+    Returns: first max_bytes bytes of body.
+    '''
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) >= max_bytes:
+            break
+    return bytes(body[:max_bytes])
+
+
+async def read_form(request):
+    '''
+    Parses form of request from at most MAX_REQUEST_BYTES of body, as 
+    request.form() would spool a chunked body of any size to disk.
+    Returns: form of request, empty if request is not a form, 
+            or None if body is larger than MAX_REQUEST_BYTES.
+    '''
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type not in ("multipart/form-data", "application/x-www-form-urlencoded"):
+        return FormData()
+    body = await read_body(request, MAX_REQUEST_BYTES + 1)
+    if len(body) > MAX_REQUEST_BYTES:
+        return None
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return await Request(request.scope, receive).form()
+
+
+async def load_binary_image(request, form, allow_handle=False):
+    '''
+    Reads image sent as multipart file field "image" or as raw
+    application/octet-stream body with image_name in query string.
+    form: form of request returned by read_form.
+    allow_handle: accept image_handle form field or query string parameter instead of image.
+    Returns: (image_handle, cache entry, None) or (None, None, error response).
+    '''
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > MAX_IMAGE_BYTES:
+        return None, None, make_response("image_too_large")
+    image_handle = form.get("image_handle", request.query_params.get("image_handle")) if allow_handle else None
+    if image_handle is not None:
+        entry = get_cached_image(request.state.identity, image_handle)
+        if entry is None:
+            return None, None, make_response("image_handle_not_found")
+        return image_handle, entry, None
+    if "image" in form:
+        image_name, image_bytes = form["image"].filename, await form["image"].read(MAX_IMAGE_BYTES + 1)
+    elif request.headers.get("content-type", "").split(";")[0].strip() == "application/octet-stream":
+        image_name, image_bytes = request.query_params.get("image_name"), await read_body(request, MAX_IMAGE_BYTES + 1)
+    else:
+        return None, None, make_response("file_not_found_in_request")
+    if image_name is None or not verify_file_extension(image_name):
+        return None, None, make_response("file_extension_error")
+    image_handle, entry, error = await run_in_detect_executor(load_image, request.state.identity, image_bytes)
+    if error is not None:
+        return None, None, make_response(error)
+    return image_handle, entry, None
+
+
+async def detect_entry(image_handle, entry):
+    '''
+    Detects faces of cached image in detect_executor unless they are already detected. 
+    Concurrent requests are detected in batches by detect_faces_scheduled.
+    Returns: success response holding bboxes and image_handle.
+    '''
+    if entry["bboxes"] is None:
+        entry["bboxes"] = await run_in_detect_executor(detect_faces_scheduled, entry["img"])
+    return make_response("success", bboxes=entry["bboxes"], image_handle=image_handle)
+
+
+def submit_response(token):
+    '''
+    Returns: response holding token of submitted task or too_many_tasks error.
+    '''
+    if token is None:
+        return make_response("too_many_tasks")
+    return make_response("success", token=token)
+
+
+@jwt_required
+async def detect_faces_callback(request, data):
+    if not verify_data(data, "image_data", "image_name"):
+        return make_response("insufficient_data")
+    image_handle, entry, error = await load_json_image(request.state.identity, data)
+    if error is not None:
+        return error
+    return await detect_entry(image_handle, entry)
+
+
+@jwt_required
+async def search_matching_faces_callback(request, data):
+    if not verify_data(data, "bboxes"):
+        return make_response("insufficient_data")
+    image_handle, entry, error = await load_json_image(request.state.identity, data)
+    if error is not None:
+        return error
+    return submit_response(await asyncio.to_thread(
+        submit_task,
+        search_matching_faces, entry["img"], data["bboxes"], image_hash=image_handle,
+        starred_first=bool(data.get("starred_first", False)),
+        user=request.state.identity, priority=data.get("priority"), cost=estimate_task_cost(data["bboxes"])))
+
+
+@jwt_required
+async def detect_faces_binary_callback(request, data):
+    form = await read_form(request)
+    if form is None:
+        return make_response("image_too_large")
+    image_handle, entry, error = await load_binary_image(request, form)
+    if error is not None:
+        return error
+    return await detect_entry(image_handle, entry)
+
+
+@jwt_required
+async def search_matching_faces_binary_callback(request, data):
+    form = await read_form(request)
+    if form is None:
+        return make_response("image_too_large")
+    bboxes = parse_bboxes(form.get("bboxes", request.query_params.get("bboxes")))
+    if bboxes is None:
+        return make_response("insufficient_data")
+    image_handle, entry, error = await load_binary_image(request, form, allow_handle=True)
+    if error is not None:
+        return error
+    priority = form.get("priority", request.query_params.get("priority"))
+    starred_first = parse_flag(form.get("starred_first", request.query_params.get("starred_first")))
+    return submit_response(await asyncio.to_thread(
+        submit_task,
+        search_matching_faces, entry["img"], bboxes, image_hash=image_handle, starred_first=starred_first,
+        user=request.state.identity, priority=priority, cost=estimate_task_cost(bboxes)))
+
+
+@jwt_required
+async def identify_faces_callback(request, data):
+    image_handle, entry, error = await load_json_image(request.state.identity, data)
+    if error is not None:
+        return error
+    overlapped = bool(data.get("overlapped", False))
+    return submit_response(await asyncio.to_thread(
+        submit_task,
+        identify_faces, entry["img"], image_hash=image_handle, bboxes=entry["bboxes"], overlapped=overlapped,
+        starred_first=bool(data.get("starred_first", False)),
+        user=request.state.identity, priority=data.get("priority"), cost=estimate_task_cost(entry["bboxes"])))
+
+
+@jwt_required
+async def get_task_progress_callback(request, data):
+    if not verify_data(data, "token"):
+        return make_response("insufficient_data")
+    progress = get_progress(data["token"])
+    if progress is None:
+        return make_response("task_not_found")
+    if is_task_cancelled(data["token"]):
+        return make_response("task_cancelled")
+    return make_response(
+        "success", progress=progress, eta=get_eta(data["token"]), queue_position=get_queue_position(data["token"]),
+        partial_result=await asyncio.to_thread(get_partial_result, data["token"]))
+
+
+@jwt_required
+async def stream_task_progress_callback(request, data):
+    if not verify_data(data, "token"):
+        return make_response("insufficient_data")
+    token = data["token"]
+    if get_progress(token) is None:
+        return make_response("task_not_found")
+
+    async def generate():
+        last_state = None
+        last_partial_count = 0
+        while True:
+            # Progress is a shared memory read, so an idle stream costs one
+            # timer per STREAM_POLL_INTERVAL on event loop.
+            completed = wait_task(token, 0)
+            progress = get_progress(token)
+            if completed is None or progress is None:
+                yield format_event("error", {
+                    "status_code": status_codes["task_not_found"],
+                    "message": response_messages["task_not_found"]
+                })
+                return
+            if is_task_cancelled(token):
+                yield format_event("error", {
+                    "status_code": status_codes["task_cancelled"],
+                    "message": response_messages["task_cancelled"]
+                })
+                return
+            state = (progress, get_queue_position(token))
+            if state != last_state:
+                last_state = state
+                yield format_event("progress", {"progress": progress, "eta": get_eta(token), "queue_position": state[1]})
+            partial_count = get_partial_count(token)
+            if partial_count != last_partial_count and not completed:
+                last_partial_count = partial_count
+                # Manager dict is read in a thread, it is an IPC round trip.
+                yield format_event("partial", {"partial_result": await asyncio.to_thread(get_partial_result, token)})
+            if completed:
+                try:
+                    result = get_result(token)
+                except TaskFailed:
+                    status = "task_cancelled" if is_task_cancelled(token) else "task_failed"
+                    yield format_event("error", {
+                        "status_code": status_codes[status],
+                        "message": response_messages[status]
+                    })
+                    return
+                yield format_event("result", {
+                    "status_code": status_codes["success"],
+                    "message": response_messages["success"],
+                    "result": result
+                })
+                return
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=headers)
+
+
+@jwt_required
+async def get_task_result_callback(request, data):
+    if not verify_data(data, "token"):
+        return make_response("insufficient_data")
+    # Completed results are returned without waiting, get_result would block.
+    completed = wait_task(data["token"], 0)
+    if completed is None:
+        return make_response("task_not_found")
+    if is_task_cancelled(data["token"]):
+        return make_response("task_cancelled")
+    if "cursor" in data:
+        cursor = data["cursor"]
+        if not is_valid_cursor(cursor):
+            return make_response("invalid_cursor")
+        incremental = await asyncio.to_thread(get_incremental_result, data["token"], cursor)
+        if incremental is None:
+            return make_response("task_not_found")
+        if incremental is False:
+            return make_response("task_cancelled" if is_task_cancelled(data["token"]) else "task_failed")
+        results, cursor, completed = incremental
+        return make_response("success", result=results, cursor=cursor, completed=completed)
+    if not completed:
+        return make_response("task_not_completed")
+    try:
+        return make_response("success", result=get_result(data["token"]))
+    except TaskFailed:
+        return make_response("task_cancelled" if is_task_cancelled(data["token"]) else "task_failed")
+
+
+@jwt_required
+async def cancel_task_callback(request, data):
+    if not verify_data(data, "token"):
+        return make_response("insufficient_data")
+    cancelled = cancel_task(data["token"])
+    if cancelled is None:
+        return make_response("task_not_found")
+    return make_response("success", result=cancelled)
+
+
+@jwt_required
+async def search_person_callback(request, data):
+    if not verify_data(data, "name"):
+        return make_response("insufficient_data")
+    persons = await asyncio.to_thread(search_person_by_name, data["name"], 100)
+    return make_response("success", result=await asyncio.to_thread(read_persons, persons))
+
+
+@jwt_required
+async def add_star_to_person_callback(request, data):
+    if not verify_data(data, "id"):
+        return make_response("insufficient_data")
+    result = await asyncio.to_thread(add_star_to_person, data["id"], STARRED_PERSON_COUNT_LIMIT)
+    if not result:
+        return make_response("starred_persons_limit_reached")
+    return make_response("success", result=result)
+
+
+@jwt_required
+async def remove_star_from_person_callback(request, data):
+    if not verify_data(data, "id"):
+        return make_response("insufficient_data")
+    await asyncio.to_thread(remove_star_from_person, data["id"])
+    return make_response("success", result=True)
+
+
+@jwt_required
+async def get_starred_persons_callback(request, data):
+    persons = await asyncio.to_thread(get_starred_persons)
+    return make_response("success", result=await asyncio.to_thread(read_persons, persons))
+
+
+routes = [
+    Route("/login", login_callback, methods=["POST"]),
+    Route("/get-fresh-token", get_fresh_token_callback, methods=["POST"]),
+    Route("/", root_callback, methods=["POST"]),
+    Route("/get-face-image", get_face_image_callback, methods=["POST"]),
+    Route("/get-person-data", get_person_data_callback, methods=["POST"]),
+    Route("/detect-faces", detect_faces_callback, methods=["POST"]),
+    Route("/search-matching-faces", search_matching_faces_callback, methods=["POST"]),
+    Route("/detect-faces-binary", detect_faces_binary_callback, methods=["POST"]),
+    Route("/search-matching-faces-binary", search_matching_faces_binary_callback, methods=["POST"]),
+    Route("/identify-faces", identify_faces_callback, methods=["POST"]),
+    Route("/get-task-progress", get_task_progress_callback, methods=["POST"]),
+    Route("/stream-task-progress", stream_task_progress_callback, methods=["POST"]),
+    Route("/get-task-result", get_task_result_callback, methods=["POST"]),
+    Route("/cancel-task", cancel_task_callback, methods=["POST"]),
+    Route("/search-person", search_person_callback, methods=["POST"]),
+    Route("/add-star-to-person", add_star_to_person_callback, methods=["POST"]),
+    Route("/remove-star-from-person", remove_star_from_person_callback, methods=["POST"]),
+    Route("/get-starred-persons", get_starred_persons_callback, methods=["POST"])
+]
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    '''
+    Starts inference pool before serving, also when app is run by uvicorn command.
+    '''
+    init_pool()
+    await asyncio.to_thread(print_worker_report)
+    yield
+
+
+app = Starlette(routes=routes, lifespan=lifespan)
+
+if __name__ == "__main__":
+    import uvicorn
+    try:
+        uvicorn.run(app, host="0.0.0.0", port=8080)
+    except KeyboardInterrupt as e:
+        print("Keyboard interrupt. Stopping server")
@@ -0,0 +1,91 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class BatchScheduler(object):
+    '''
+    Collects items submitted by many threads into batches and runs them
+    through one batched function on a single thread. A batch is dispatched
+    once it holds max_batch_size items or max_wait_ms milliseconds after its
+    first item arrived, whichever comes first.
+    '''
+    def __init__(self, func, max_batch_size, max_wait_ms):
+        '''
+        func: function taking a list of items and returning a list of results in same order.
+        max_batch_size: maximum number of items per batch.
+        max_wait_ms: maximum time first item of a batch waits for more items.
+        '''
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms/1000.0
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        '''
+        item: input of func.
+        Returns: Future resolved with result of item.
+        '''
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                # Items already queued join the batch even after deadline.
+                if timeout <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # Items whose future was cancelled while queued are dropped.
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self.func(items)
+            except Exception as e:
+                if len(items) == 1:
+                    futures[0].set_exception(e)
+                else:
+                    # One bad item must not fail the others, items are rerun alone.
+                    self._run_singly(items, futures)
+            else:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            self.batches += 1
+            self.items += len(items)
+
+    def _run_singly(self, items, futures):
+        for item, future in zip(items, futures):
+            try:
+                future.set_result(self.func([item])[0])
+            except Exception as e:
+                future.set_exception(e)
+
+    def stats(self):
+        '''
+        Returns: dictionary of number of batches, items and mean batch size.
+        '''
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items/self.batches if self.batches else 0.0
+        }
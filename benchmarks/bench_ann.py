@@ -0,0 +1,94 @@
+import time
+import argparse
+import numpy as np
+
+from gallery import Gallery, get_gallery
+from ann_index import IVFIndex
+from embedding_store import l2_normalize
+from config import FACE_MATCH_THRESHOLD
+
+# python -m benchmarks.bench_ann --num_persons 200000 --nlist 512
+
+def synthetic_gallery(num_persons, dim, num_clusters=64, seed=0):
+    '''
+    Returns: (ids, encodings) of persons drawn around num_clusters centres,
+            which mimics how real face encodings group together.
+    '''
+    rng = np.random.default_rng(seed)
+    centres = l2_normalize(rng.normal(size=(num_clusters, dim)))
+    labels = rng.integers(0, num_clusters, num_persons)
+    encodings = l2_normalize(centres[labels] + 0.9*l2_normalize(rng.normal(size=(num_persons, dim))))
+    ids = ["person_{}".format(i) for i in range(num_persons)]
+    return ids, encodings
+
+
+def make_queries(encodings, num_queries, noise, seed=1):
+    '''
+    Returns: num_queries noisy copies of random gallery encodings.
+    '''
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(encodings), num_queries, replace=False)
+    return l2_normalize(encodings[rows] + noise*l2_normalize(rng.normal(size=(num_queries, encodings.shape[1]))))
+
+
+def exact_knn(gallery, queries, k):
+    scores = gallery.scores(queries)
+    top = np.argsort(-scores, axis=1)[:, :k]
+    return [gallery.ids[row].tolist() for row in top]
+
+
+def recall(approx, exact):
+    '''
+    Returns: fraction of exact results found in approximate results.
+    '''
+    found = 0
+    total = 0
+    for a, e in zip(approx, exact):
+        found += len(set(a) & set(e))
+        total += len(e)
+    return found/total if total > 0 else 1.0
+
+
+def timed(fn, *args, **kwargs):
+    tic = time.time()
+    out = fn(*args, **kwargs)
+    return out, time.time() - tic
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@k versus latency of IVF index against exact search")
+    parser.add_argument("--num_persons", default=100000, type=int)
+    parser.add_argument("--dim", default=512, type=int)
+    parser.add_argument("--num_queries", default=200, type=int)
+    parser.add_argument("--noise", default=0.6, type=float, help="query noise relative to unit encoding")
+    parser.add_argument("--k", default=10, type=int)
+    parser.add_argument("--nlist", default=None, type=int)
+    parser.add_argument("--nprobes", default="1,2,4,8,16,32,64")
+    parser.add_argument("--use_gallery", action="store_true", help="benchmark on gallery of this server")
+    args = parser.parse_args()
+
+    if args.use_gallery:
+        gallery = get_gallery()
+        gallery.index = None
+    else:
+        ids, encodings = synthetic_gallery(args.num_persons, args.dim)
+        gallery = Gallery(ids, encodings, normalized=True)
+    queries = make_queries(gallery.encodings, args.num_queries, args.noise)
+    nlist = args.nlist or max(1, int(4*np.sqrt(len(gallery))))
+
+    index, build_time = timed(IVFIndex.build, gallery.ids, gallery.encodings, nlist)
+    print("gallery: {} persons, index: {} lists built in {:.2f}s".format(len(gallery), nlist, build_time))
+
+    exact_threshold, exact_time = timed(gallery.search, queries, FACE_MATCH_THRESHOLD)
+    exact_top = exact_knn(gallery, queries, args.k)
+    print("{:>8} {:>14} {:>10} {:>18}".format("nprobe", "ms/query", "recall@{}".format(args.k), "threshold recall"))
+    print("{:>8} {:>14.3f} {:>10.4f} {:>18.4f}".format("exact", 1000*exact_time/len(queries), 1.0, 1.0))
+    for nprobe in map(int, args.nprobes.split(",")):
+        approx_threshold, approx_time = timed(index.search, queries, FACE_MATCH_THRESHOLD, nprobe)
+        approx_top = index.search_knn(queries, args.k, nprobe)
+        print("{:>8} {:>14.3f} {:>10.4f} {:>18.4f}".format(
+            nprobe,
+            1000*approx_time/len(queries),
+            recall(approx_top, exact_top),
+            recall(approx_threshold, exact_threshold)
+        ))
@@ -0,0 +1,90 @@
+import time
+import argparse
+import threading
+import numpy as np
+
+from batch_scheduler import BatchScheduler
+
+# python -m benchmarks.bench_batching --clients 16
+# python -m benchmarks.bench_batching --model detect --size 480,640
+
+def synthetic_model(base_ms, item_ms):
+    '''
+    Returns: batched function sleeping base_ms + item_ms per item, a stand-in
+            for a forward pass whose fixed cost is amortised by batching.
+            A lock makes concurrent calls contend like forward passes sharing cores.
+    '''
+    lock = threading.Lock()
+    def run(items):
+        with lock:
+            time.sleep((base_ms + item_ms*len(items))/1000.0)
+        return [None]*len(items)
+    return run
+
+
+def real_model(name):
+    '''
+    Returns: batched detect or encode function of model_utils.
+    '''
+    from face_detector.detector import detect_faces_batch
+    from face_encoder.encoder import encode_faces
+    if name == "detect":
+        return detect_faces_batch
+    return lambda imgs: list(encode_faces(imgs))
+
+
+def load_test(submit, item, clients, requests_per_client):
+    '''
+    Runs closed-loop clients each sending requests_per_client requests back to back.
+    Returns: (throughput in requests/s, array of latencies in ms).
+    '''
+    latencies = [[] for _ in range(clients)]
+    def client(k):
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            submit(item)
+            latencies[k].append(1000*(time.perf_counter() - start))
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return clients*requests_per_client/elapsed, np.concatenate(latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput versus latency of micro-batching")
+    parser.add_argument("--model", default="synthetic", choices=["synthetic", "detect", "encode"])
+    parser.add_argument("--size", default="480,640", help="image size as height,width for real models")
+    parser.add_argument("--base_ms", default=20.0, type=float, help="fixed cost of synthetic forward pass")
+    parser.add_argument("--item_ms", default=2.0, type=float, help="per item cost of synthetic forward pass")
+    parser.add_argument("--clients", default=16, type=int)
+    parser.add_argument("--requests", default=20, type=int, help="requests per client")
+    parser.add_argument("--batch_sizes", default="1,4,8,16")
+    parser.add_argument("--waits", default="0,2,5,10", help="max wait in ms")
+    args = parser.parse_args()
+
+    if args.model == "synthetic":
+        func = synthetic_model(args.base_ms, args.item_ms)
+        item = None
+    else:
+        func = real_model(args.model)
+        h, w = map(int, args.size.split(","))
+        if args.model == "encode":
+            h, w = 112, 112
+        item = np.random.default_rng(0).integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+    # Baseline: every client thread calls the model directly, as Flask threads did.
+    throughput, latencies = load_test(lambda x: func([x]), item, args.clients, args.requests)
+    print("{:<16} {:>10} {:>10} {:>10} {:>10}".format("config", "req/s", "p50 ms", "p99 ms", "batch"))
+    print("{:<16} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+        "direct", throughput, np.percentile(latencies, 50), np.percentile(latencies, 99), 1.0))
+    for batch_size in map(int, args.batch_sizes.split(",")):
+        for wait in map(float, args.waits.split(",")):
+            scheduler = BatchScheduler(func, batch_size, wait)
+            throughput, latencies = load_test(lambda x: scheduler.submit(x).result(), item, args.clients, args.requests)
+            print("{:<16} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                "n={} t={:g}ms".format(batch_size, wait), throughput,
+                np.percentile(latencies, 50), np.percentile(latencies, 99), scheduler.stats()["mean_batch_size"]))
@@ -0,0 +1,84 @@
+import argparse
+import numpy as np
+import torch
+
+from utils import read_image
+from face_detector.detector import (
+    net,
+    cfg,
+    args as detector_args,
+    device,
+    get_priors,
+    decode,
+    decode_landm,
+    cpu_nms,
+    _Stage,
+    _postprocess,
+    _format_bboxes
+)
+
+# python -m benchmarks.bench_detect_stages --image some_photo.jpg
+
+def legacy_postprocess(loc, conf, landms, prior_data, im_height, im_width, timers):
+    '''
+    Post-processing as detect_faces did it before filtering moved on device:
+    every prior and landmark is decoded and copied to host before thresholding.
+    '''
+    with _Stage(timers, "decode"):
+        scale = torch.Tensor([im_width, im_height, im_width, im_height]).to(device)
+        boxes = decode(loc, prior_data, cfg['variance']) * scale
+        scale1 = torch.Tensor([im_width, im_height]*5).to(device)
+        landms = decode_landm(landms, prior_data, cfg['variance']) * scale1
+    with _Stage(timers, "copy"):
+        boxes = boxes.cpu().numpy()
+        scores = conf.cpu().numpy()[:, 1]
+        landms = landms.cpu().numpy()
+    with _Stage(timers, "filter"):
+        inds = np.where(scores > detector_args.confidence_threshold)[0]
+        boxes, landms, scores = boxes[inds], landms[inds], scores[inds]
+        order = scores.argsort()[::-1][:detector_args.top_k]
+        boxes, landms, scores = boxes[order], landms[order], scores[order]
+    with _Stage(timers, "nms"):
+        dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
+        keep = cpu_nms(dets, detector_args.nms_threshold, detector_args.keep_top_k)
+        dets = dets[keep]
+    return dets
+
+
+def report(name, timers, repeat):
+    total = sum(t.total_time for t in timers.values())
+    stages = ", ".join("{} {:.2f}".format(k, 1000*t.total_time/repeat) for k, t in timers.items())
+    print("{:<8} {:>8.2f} ms/image  ({})".format(name, 1000*total/repeat, stages))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-stage timing of detection post-processing")
+    parser.add_argument("--image", default=None, help="image to detect on, random noise if not given")
+    parser.add_argument("--size", default="1080,1920", help="size of random image as height,width")
+    parser.add_argument("--repeat", default=10, type=int)
+    args = parser.parse_args()
+
+    if args.image is not None:
+        img = read_image(args.image)
+    else:
+        h, w = map(int, args.size.split(","))
+        img = np.random.default_rng(0).integers(0, 256, (h, w, 3), dtype=np.uint8)
+    im_height, im_width, _ = img.shape
+    with torch.no_grad():
+        prior_data = get_priors(cfg, (im_height, im_width), device)
+        batch = torch.from_numpy(img.transpose(2, 0, 1).astype(np.float32)).unsqueeze(0).to(device)
+        loc, conf, landms = net(batch)
+        loc, conf, landms = loc[0], conf[0], landms[0]
+        runs = [
+            ("legacy", lambda timers: legacy_postprocess(loc, conf, landms, prior_data, im_height, im_width, timers)),
+            ("lean", lambda timers: _postprocess(loc, conf, landms, prior_data, im_height, im_width, False, timers)),
+            ("lean+lm", lambda timers: _postprocess(loc, conf, landms, prior_data, im_height, im_width, True, timers))
+        ]
+        outputs = {}
+        for name, fn in runs:
+            timers = {}
+            for _ in range(args.repeat):
+                outputs[name] = fn(timers)
+            report(name, timers, args.repeat)
+    print("same bboxes: {}".format(
+        _format_bboxes(outputs["legacy"], im_height, im_width) == _format_bboxes(outputs["lean"], im_height, im_width)))
@@ -0,0 +1,71 @@
+import time
+import argparse
+import numpy as np
+import torch
+
+from face_detector.utils.nms.py_cpu_nms import py_cpu_nms
+from face_detector.utils.nms.fast_nms import (
+    cpu_nms,
+    torch_nms,
+    torch_nms_reference,
+    batched_nms
+)
+
+# python -m benchmarks.bench_nms --num_boxes 5000
+
+def synthetic_dets(num_boxes, num_faces=30, size=(1080, 1920), seed=0):
+    '''
+    Returns: float32 array of shape Nx5 of boxes jittered around num_faces
+            faces, which is how boxes look after confidence filtering.
+    '''
+    rng = np.random.default_rng(seed)
+    h, w = size
+    centres = rng.uniform((0, 0), (w, h), (num_faces, 2))
+    sizes = rng.uniform(20, 200, num_faces)
+    face = rng.integers(0, num_faces, num_boxes)
+    cxcy = centres[face] + rng.normal(0, 0.15, (num_boxes, 2))*sizes[face, np.newaxis]
+    wh = sizes[face, np.newaxis]*rng.uniform(0.8, 1.2, (num_boxes, 2))
+    scores = rng.uniform(0.02, 1.0, num_boxes)
+    return np.hstack((cxcy - wh/2, cxcy + wh/2, scores[:, np.newaxis])).astype(np.float32)
+
+
+def bench(fn, repeat):
+    fn()
+    tic = time.time()
+    for _ in range(repeat):
+        out = fn()
+    return out, 1000*(time.time() - tic)/repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare NMS implementations")
+    parser.add_argument("--num_boxes", default=5000, type=int)
+    parser.add_argument("--num_images", default=8, type=int, help="images in batched variant")
+    parser.add_argument("--thresh", default=0.4, type=float)
+    parser.add_argument("--keep_top_k", default=750, type=int)
+    parser.add_argument("--repeat", default=10, type=int)
+    args = parser.parse_args()
+
+    dets = synthetic_dets(args.num_boxes)
+    reference, ms = bench(lambda: py_cpu_nms(dets, args.thresh)[:args.keep_top_k], args.repeat)
+    print("{:<28} {:>10.3f} ms  kept {}".format("py_cpu_nms", ms, len(reference)))
+    out, ms = bench(lambda: cpu_nms(dets, args.thresh, args.keep_top_k), args.repeat)
+    print("{:<28} {:>10.3f} ms  kept {}  same {}".format("cpu_nms", ms, len(out), list(out) == list(reference)))
+
+    devices = [torch.device("cpu")] + ([torch.device("cuda")] if torch.cuda.is_available() else [])
+    for device in devices:
+        boxes = torch.from_numpy(dets[:, :4]).to(device)
+        scores = torch.from_numpy(dets[:, 4]).to(device)
+        out, ms = bench(lambda: torch_nms(boxes, scores, args.thresh, args.keep_top_k).tolist(), args.repeat)
+        print("{:<28} {:>10.3f} ms  kept {}  same {}".format("torch_nms ({})".format(device), ms, len(out), out == list(reference)))
+        out, ms = bench(lambda: torch_nms_reference(boxes, scores, args.thresh, args.keep_top_k).tolist(), args.repeat)
+        print("{:<28} {:>10.3f} ms  kept {}  same {}".format("torch_nms_reference ({})".format(device), ms, len(out), out == list(reference)))
+
+        all_dets = [synthetic_dets(args.num_boxes, seed=i) for i in range(args.num_images)]
+        boxes = torch.from_numpy(np.concatenate([d[:, :4] for d in all_dets])).to(device)
+        scores = torch.from_numpy(np.concatenate([d[:, 4] for d in all_dets])).to(device)
+        idxs = torch.arange(args.num_images, device=device).repeat_interleave(args.num_boxes)
+        _, ms = bench(lambda: batched_nms(boxes, scores, idxs, args.thresh, args.keep_top_k).tolist(), args.repeat)
+        _, loop_ms = bench(lambda: [cpu_nms(d, args.thresh, args.keep_top_k) for d in all_dets], args.repeat)
+        print("{:<28} {:>10.3f} ms  ({} images, cpu_nms loop {:.3f} ms)".format(
+            "batched_nms ({})".format(device), ms, args.num_images, loop_ms))
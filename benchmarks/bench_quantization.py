@@ -0,0 +1,61 @@
+import argparse
+
+from gallery import Gallery
+from quantization import CompressedIndex
+from benchmarks.bench_ann import (
+    synthetic_gallery,
+    make_queries,
+    timed
+)
+from config import FACE_MATCH_THRESHOLD
+
+# python -m benchmarks.bench_quantization --num_persons 100000
+
+def decision_agreement(approx, exact):
+    '''
+    Returns: (precision, recall) of approximate matches against exact matches.
+    '''
+    tp = fp = fn = 0
+    for a, e in zip(approx, exact):
+        a, e = set(a), set(e)
+        tp += len(a & e)
+        fp += len(a - e)
+        fn += len(e - a)
+    precision = tp/(tp + fp) if tp + fp > 0 else 1.0
+    recall = tp/(tp + fn) if tp + fn > 0 else 1.0
+    return precision, recall
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory and latency of compressed gallery against full precision search")
+    parser.add_argument("--num_persons", default=100000, type=int)
+    parser.add_argument("--dim", default=512, type=int)
+    parser.add_argument("--num_queries", default=100, type=int)
+    parser.add_argument("--noise", default=0.6, type=float)
+    parser.add_argument("--margins", default="none,0.3,0.2,0.1", help="PQ rescore margins, none is the strict bound")
+    args = parser.parse_args()
+
+    ids, encodings = synthetic_gallery(args.num_persons, args.dim)
+    gallery = Gallery(ids, encodings, normalized=True)
+    queries = make_queries(encodings, args.num_queries, args.noise)
+
+    exact, exact_time = timed(gallery.search, queries, FACE_MATCH_THRESHOLD)
+    print("{:>12} {:>12} {:>12} {:>10} {:>10}".format("mode", "memory MB", "ms/query", "precision", "recall"))
+    # Memory that np.array(person_data["face_encoding"]) used to take.
+    print("{:>12} {:>12.1f} {:>12} {:>10} {:>10}".format(
+        "float64", args.num_persons*args.dim*8/(1024*1024), "-", "-", "-"))
+    print("{:>12} {:>12.1f} {:>12.3f} {:>10.4f} {:>10.4f}".format(
+        "float32", gallery.encodings.nbytes/(1024*1024), 1000*exact_time/len(queries), 1.0, 1.0))
+    for mode in ["int8", "pq"]:
+        index, build_time = timed(CompressedIndex.build, ids, encodings, mode)
+        # Recall loss of capping the PQ error bound by PQ_RESCORE_MARGIN.
+        margins = [None] if mode == "int8" else [None if m == "none" else float(m) for m in args.margins.split(",")]
+        for margin in margins:
+            name = mode
+            if mode == "pq":
+                index.quantizer.rescore_margin = margin
+                name = "pq m={}".format("none" if margin is None else "{:g}".format(margin))
+            approx, approx_time = timed(index.search, queries, FACE_MATCH_THRESHOLD)
+            precision, recall = decision_agreement(approx, exact)
+            print("{:>12} {:>12.1f} {:>12.3f} {:>10.4f} {:>10.4f}   (built in {:.1f}s)".format(
+                name, index.nbytes()/(1024*1024), 1000*approx_time/len(queries), precision, recall, build_time))
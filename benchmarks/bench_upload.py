@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import base64
+import argparse
+import urllib.parse
+import urllib.request
+
+# python -m benchmarks.bench_upload --image photo.jpg --username admin --password ...
+
+def post(url, body, headers):
+    '''
+    Returns: (parsed json response, seconds taken by request).
+    '''
+    req = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    tic = time.time()
+    with urllib.request.urlopen(req) as resp:
+        out = json.loads(resp.read().decode("UTF-8"))
+    return out, time.time() - tic
+
+
+def base64_request(url, token, image_name, image_bytes):
+    body = json.dumps({
+        "access_token": token, 
+        "image_name": image_name, 
+        "image_data": base64.b64encode(image_bytes).decode("UTF-8")
+    }).encode("UTF-8")
+    return url + "/detect-faces", body, {"Content-Type": "application/json"}
+
+
+def octet_stream_request(url, token, image_name, image_bytes):
+    query = urllib.parse.urlencode({"image_name": image_name})
+    headers = {"Content-Type": "application/octet-stream", "Authorization": "Bearer " + token}
+    return url + "/detect-faces-binary?" + query, image_bytes, headers
+
+
+def multipart_request(url, token, image_name, image_bytes):
+    boundary = "----cmu-bench-boundary"
+    body = b"".join([
+        "--{}\r\n".format(boundary).encode("UTF-8"), 
+        'Content-Disposition: form-data; name="image"; filename="{}"\r\n'.format(image_name).encode("UTF-8"), 
+        b"Content-Type: application/octet-stream\r\n\r\n", 
+        image_bytes, 
+        "\r\n--{}--\r\n".format(boundary).encode("UTF-8")
+    ])
+    headers = {
+        "Content-Type": "multipart/form-data; boundary={}".format(boundary), 
+        "Authorization": "Bearer " + token
+    }
+    return url + "/detect-faces-binary", body, headers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare base64 JSON uploads with binary uploads on a running server")
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--image", required=True)
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--repeat", default=10, type=int)
+    args = parser.parse_args()
+
+    login = json.dumps({"username": args.username, "password": args.password}).encode("UTF-8")
+    resp, _ = post(args.url + "/login", login, {"Content-Type": "application/json"})
+    token = resp["access_token"]
+    with open(args.image, "rb") as f:
+        image_bytes = f.read()
+    image_name = os.path.basename(args.image)
+
+    print("{:<14} {:>12} {:>12}  {}".format("upload", "body bytes", "ms/request", "bboxes"))
+    for name, make in [("base64 json", base64_request), ("octet-stream", octet_stream_request), ("multipart", multipart_request)]:
+        total = 0.0
+        for _ in range(args.repeat):
+            # Random trailing bytes, ignored by decoders, give every request a new 
+            # content hash so that no request is served from server's image cache.
+            url, body, headers = make(args.url, token, image_name, image_bytes + os.urandom(16))
+            resp, seconds = post(url, body, headers)
+            total += seconds
+        print("{:<14} {:>12} {:>12.1f}  {}".format(name, len(body), 1000*total/args.repeat, resp.get("bboxes")))
@@ -0,0 +1,119 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Thread safe least recently used cache bounded by total size of its values.
+    Entries optionally expire ttl seconds after they were last put.
+    '''
+    def __init__(self, max_bytes, ttl=None):
+        '''
+        max_bytes: maximum total size of values held in cache.
+        ttl: seconds after which an entry expires or None to never expire.
+        '''
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Keys in order of insertion, which is order of expiry as ttl is fixed.
+        self._expiries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def _remove(self, key):
+        value, nbytes, expires_at = self._entries.pop(key)
+        self._expiries.pop(key, None)
+        self.nbytes -= nbytes
+
+    def _evict_expired(self, now):
+        # Stops at first entry that has not expired, so a put costs
+        # one lookup unless entries are due.
+        while self._expiries:
+            key, expires_at = next(iter(self._expiries.items()))
+            if expires_at > now:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def get(self, key, count=True):
+        '''
+        key: key of entry.
+        count: count this lookup in hits and misses.
+        Returns: value of key or None if key is not cached or has expired.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.time():
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[0]
+
+    def get_many(self, keys):
+        '''
+        keys: list of keys of entries.
+        Returns: list of value of every key or None where key is not cached, 
+                one round trip when cache is used through a manager proxy.
+        '''
+        return [self.get(key) for key in keys]
+
+    def put(self, key, value, nbytes):
+        '''
+        key: key of entry.
+        value: value to be cached.
+        nbytes: size of value counted against max_bytes.
+        Returns: True if value is cached, False if it is larger than max_bytes.
+        '''
+        if nbytes > self.max_bytes:
+            return False
+        with self._lock:
+            now = time.time()
+            if key in self._entries:
+                self._remove(key)
+            self._evict_expired(now)
+            while self.nbytes + nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            expires_at = now + self.ttl if self.ttl is not None else None
+            self._entries[key] = (value, nbytes, expires_at)
+            if expires_at is not None:
+                self._expiries[key] = expires_at
+            self.nbytes += nbytes
+        return True
+
+    def put_many(self, entries):
+        '''
+        entries: list of (key, value, nbytes) tuples.
+        Returns: list of return values of put.
+        '''
+        return [self.put(key, value, nbytes) for key, value, nbytes in entries]
+
+    def stats(self):
+        '''
+        Returns: dictionary of entries, bytes, hits, misses and evictions of cache.
+        '''
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
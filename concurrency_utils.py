@@ -1,13 +1,537 @@
 import os
 import math
-from multiprocessing import Pool, Manager, TimeoutError
+import time
+import atexit
+import heapq
+import queue
+import itertools
+import threading
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import TimeoutError
+from multiprocessing.managers import SyncManager
+
+import psutil
 
 from utils import get_unique_id
+from cache_utils import LRUCache
+from inference_worker import init_worker
+from progress_table import ProgressTable, TaskCancelled
+from config import (
+    TASK_TTL, 
+    MAX_RETAINED_TASKS, 
+    TASK_EVICTION_INTERVAL, 
+    INFERENCE_WORKERS, 
+    INFERENCE_THREADS_PER_WORKER, 
+    INFERENCE_START_METHOD, 
+    TASK_PRIORITIES, 
+    DEFAULT_TASK_PRIORITY, 
+    HIGH_PRIORITY_USERS, 
+    EMBEDDING_CACHE_MAX_BYTES
+)
+
+
+class TaskFailed(Exception):
+    '''
+    Raised by get_result when task raised an error in its worker.
+    '''
+    pass
+
+
+class SharedManager(SyncManager):
+    '''
+    SyncManager which also hosts LRUCache instances shared by all workers.
+    '''
+    pass
+
+SharedManager.register("LRUCache", LRUCache)
+
+
+class TaskRegistry(object):
+    '''
+    Registry of submitted tasks mapping token to AsyncResult.
+    A task is evicted together with its progress entry ttl seconds after it 
+    is found completed, or earlier when more than max_tasks tasks are retained, 
+    oldest completed tasks first. Running tasks are never evicted.
+    '''
+    def __init__(self, progress_table, partial_results, ttl=TASK_TTL, max_tasks=MAX_RETAINED_TASKS):
+        '''
+        progress_table: ProgressTable holding progress slot of every task.
+        partial_results: list of dictionaries mapping token to partial results of task.
+        ttl: seconds a completed task is retained.
+        max_tasks: maximum number of retained tasks.
+        '''
+        self.progress_table = progress_table
+        self.partial_results = partial_results
+        self.ttl = ttl
+        self.max_tasks = max_tasks
+        self.evicted = 0
+        self._tasks = OrderedDict()
+        self._completed_at = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __contains__(self, token):
+        return token in self._tasks
+
+    def __getitem__(self, token):
+        return self._tasks[token]
+
+    def add(self, token, proc):
+        '''
+        token: unique process token generated when creating process.
+        proc: AsyncResult of task.
+        '''
+        with self._lock:
+            self._tasks[token] = proc
+        if len(self._tasks) > self.max_tasks:
+            self.evict()
+
+    def remove(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: True if task is removed else False.
+        '''
+        with self._lock:
+            if token not in self._tasks:
+                return False
+            del self._tasks[token]
+            self._completed_at.pop(token, None)
+        self.progress_table.free(token)
+        for results in self.partial_results:
+            results.pop(token, None)
+        return True
+
+    def evict(self):
+        '''
+        Evicts expired tasks and completed tasks in excess of max_tasks.
+        Returns: number of evicted tasks.
+        '''
+        now = time.time()
+        with self._lock:
+            for token, proc in self._tasks.items():
+                if token not in self._completed_at and proc.ready():
+                    self._completed_at[token] = now
+            expired = []
+            excess = len(self._tasks) - self.max_tasks
+            for token, completed_at in self._completed_at.items():
+                if completed_at + self.ttl <= now or len(expired) < excess:
+                    expired.append(token)
+            for token in expired:
+                del self._tasks[token]
+                del self._completed_at[token]
+            self.evicted += len(expired)
+        for token in expired:
+            self.progress_table.free(token)
+            for results in self.partial_results:
+                results.pop(token, None)
+        return len(expired)
+
+    def start_eviction(self, interval=TASK_EVICTION_INTERVAL):
+        '''
+        interval: seconds between evictions.
+        Starts a daemon thread evicting tasks every interval seconds.
+        '''
+        def run():
+            while True:
+                time.sleep(interval)
+                self.evict()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+class PartialResult(object):
+    '''
+    Picklable handle through which a worker publishes an early partial 
+    result of its task and results of bboxes completed so far before the 
+    task is completed.
+    '''
+    def __init__(self, results_dict, bbox_results, token, progress):
+        '''
+        results_dict: Manager dictionary mapping token to partial result.
+        bbox_results: Manager list of results of completed bboxes of task.
+        token: unique process token generated when creating process.
+        progress: ProgressHandle of task, counts published results.
+        '''
+        self.results_dict = results_dict
+        self.bbox_results = bbox_results
+        self.token = token
+        self.progress = progress
+
+    def publish(self, result):
+        '''
+        result: JSON serialisable partial result replacing any earlier one.
+        '''
+        self.results_dict[self.token] = result
+        self.progress.mark_partial()
+
+    def append_bboxes(self, results):
+        '''
+        results: results of next bboxes of task, in bbox order. Must be 
+                appended before progress of task is updated to count them.
+        Only new results are sent, so a task sends every result once.
+        '''
+        self.bbox_results.extend(results)
+
+
+class ScheduledResult(object):
+    '''
+    Result of a task held by TaskScheduler. It behaves like the AsyncResult 
+    the task gets once it is dispatched to pool.
+    '''
+    def __init__(self):
+        self._proc = None
+        self._cancelled = False
+        self._dispatched = threading.Event()
+
+    def _set(self, proc):
+        self._proc = proc
+        self._dispatched.set()
+
+    def _cancel(self):
+        self._cancelled = True
+        self._dispatched.set()
+
+    def dispatched(self):
+        return self._dispatched.is_set()
+
+    def ready(self):
+        return self._cancelled or (self._proc is not None and self._proc.ready())
+
+    def wait(self, timeout=None):
+        start = time.time()
+        if self._dispatched.wait(timeout) and not self._cancelled:
+            self._proc.wait(None if timeout is None else max(0, timeout - (time.time() - start)))
+
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if not self.ready():
+            raise TimeoutError
+        if self._cancelled:
+            raise TaskCancelled()
+        return self._proc.get()
+
+
+class TaskScheduler(object):
+    '''
+    Queue in front of pool which keeps at most max_in_flight tasks in pool. 
+    Pending tasks are dispatched by priority class, then to the user who has 
+    been served the least cost so far (fair share), then shortest job first.
+    '''
+    def __init__(self, pool, max_in_flight):
+        '''
+        pool: multiprocessing pool running tasks.
+        max_in_flight: maximum number of tasks submitted to pool at once.
+        '''
+        self.pool = pool
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        # priority -> user -> heap of (cost, seq, token, func, args, kwargs, result).
+        self._pending = {}
+        # user -> cost of tasks dispatched while user had pending tasks.
+        self._usage = {}
+        # Usage of user of last dispatched task before it was dispatched.
+        self._vtime = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(heap) for users in self._pending.values() for heap in users.values())
+
+    def _active_users(self):
+        return set(user for users in self._pending.values() for user in users)
+
+    def submit(self, token, func, args, kwargs, user=None, priority=TASK_PRIORITIES[DEFAULT_TASK_PRIORITY], cost=1):
+        '''
+        token: unique process token generated when creating process.
+        func, args, kwargs: task function and its arguments.
+        user: identity of user submitting task.
+        priority: priority class, lower is served first.
+        cost: estimated cost of task used for fair share and shortest job first.
+        Returns: ScheduledResult of task.
+        '''
+        result = ScheduledResult()
+        with self._lock:
+            active = self._active_users()
+            if not active and self.in_flight == 0:
+                self._usage = {}
+                self._vtime = 0
+            if user not in active:
+                # A returning user cannot claim service for time it was idle.
+                self._usage[user] = max(self._usage.get(user, 0), self._vtime)
+            heap = self._pending.setdefault(priority, {}).setdefault(user, [])
+            heapq.heappush(heap, (cost, next(self._seq), token, func, args, kwargs, result))
+            self._dispatch()
+        return result
+
+    @staticmethod
+    def _pick(pending, usage):
+        '''
+        Pops next task from pending. Returns: (user, heap entry) or None.
+        '''
+        for priority in sorted(pending):
+            users = pending[priority]
+            if not users:
+                continue
+            user = min(users, key=lambda u: (usage[u], users[u][0][1]))
+            entry = heapq.heappop(users[user])
+            if not users[user]:
+                del users[user]
+            if not users:
+                del pending[priority]
+            return user, entry
+        return None
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight:
+            picked = self._pick(self._pending, self._usage)
+            if picked is None:
+                return
+            user, (cost, _, _, func, args, kwargs, result) = picked
+            self._vtime = self._usage[user]
+            self._usage[user] += cost
+            self.in_flight += 1
+            result._set(self.pool.apply_async(func, args, kwargs, callback=self._done, error_callback=self._done))
+
+    def _done(self, _):
+        with self._lock:
+            self.in_flight -= 1
+            self._dispatch()
+
+    def cancel(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: True if pending task of token is removed from queue 
+                or False if it is not pending.
+        '''
+        with self._lock:
+            for priority, users in self._pending.items():
+                for user, heap in users.items():
+                    for i, entry in enumerate(heap):
+                        if entry[2] != token:
+                            continue
+                        heap.pop(i)
+                        heapq.heapify(heap)
+                        if not heap:
+                            del users[user]
+                        if not users:
+                            del self._pending[priority]
+                        entry[6]._cancel()
+                        return True
+        return False
+
+    def queue_position(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: number of pending tasks dispatched before task of token 
+                or None if task is not pending.
+        '''
+        with self._lock:
+            pending = {p: {u: list(heap) for u, heap in users.items()} for p, users in self._pending.items()}
+            usage = dict(self._usage)
+        position = 0
+        while True:
+            picked = self._pick(pending, usage)
+            if picked is None:
+                return None
+            user, entry = picked
+            if entry[2] == token:
+                return position
+            usage[user] += entry[0]
+            position += 1
+
+
+def create_inference_pool(num_workers=INFERENCE_WORKERS, num_threads=INFERENCE_THREADS_PER_WORKER, start_method=INFERENCE_START_METHOD, embedding_cache=None):
+    '''
+    num_workers: number of worker processes, number of cpu cores if None.
+    num_threads: torch threads per worker, cpu cores split evenly between workers if None.
+    start_method: multiprocessing start method of workers.
+    embedding_cache: proxy of LRUCache shared by all workers or None.
+    Returns: (pool, queue receiving pid of every worker once it is ready, 
+            number of worker processes).
+    '''
+    cpu_count = os.cpu_count() or 1
+    if num_workers is None:
+        num_workers = cpu_count
+    if num_threads is None:
+        num_threads = max(1, cpu_count//num_workers)
+    ctx = multiprocessing.get_context(start_method)
+    if start_method == "forkserver":
+        # Preloading inference_worker keeps the fork server itself free of
+        # models. Children still run spawn.prepare and import __main__ as
+        # __mp_main__, so under "python app.py" models are loaded by that
+        # import and init_worker only sets threads and the shared cache.
+        ctx.set_forkserver_preload(["inference_worker"])
+    ready_queue = ctx.Queue()
+    pool = ctx.Pool(num_workers, initializer=init_worker, initargs=(num_threads, ready_queue, embedding_cache))
+    return pool, ready_queue, num_workers
+
+
+def get_worker_report(timeout=None):
+    '''
+    timeout: seconds to wait for workers to load models, do not wait if None.
+    Returns: list of dictionaries with pid, ready flag and resident memory 
+            in MB of every inference worker. Workers are known by the pid they 
+            put in ready queue, pid and rss of workers still loading are None.
+    '''
+    deadline = time.time() + (timeout or 0)
+    report = []
+    with _ready_lock:
+        while len(_ready_workers) < _num_workers:
+            try:
+                _ready_workers.add(_ready_queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        for pid in sorted(_ready_workers):
+            try:
+                rss = psutil.Process(pid).memory_info().rss/(1024*1024)
+            except psutil.NoSuchProcess:
+                # Worker exited, pool puts pid of its replacement in ready queue.
+                _ready_workers.discard(pid)
+                continue
+            report.append({"pid": pid, "ready": True, "rss": rss})
+    report += [{"pid": None, "ready": False, "rss": None}]*(_num_workers - len(report))
+    return report
+
+
+def get_embedding_cache_stats():
+    '''
+    Returns: dictionary of entries, bytes, hits, misses and evictions 
+            of embedding cache shared by inference workers.
+    '''
+    return embedding_cache.stats()
+
+
+def print_worker_report(timeout=300):
+    '''
+    timeout: seconds to wait for workers to load models.
+    Prints resident memory of every inference worker.
+    '''
+    report = get_worker_report(timeout)
+    for worker in report:
+        if worker["ready"]:
+            print("Inference worker {}: ready RSS {:.1f} MB".format(worker["pid"], worker["rss"]))
+        else:
+            print("Inference worker: loading")
+    print("Total inference worker RSS {:.1f} MB".format(sum(worker["rss"] for worker in report if worker["ready"])))
+
+
+# Created by init_pool in server process. Workers import this module to 
+# unpickle task arguments, so nothing is created at import time.
+pool = None
+_num_workers = 0
+_ready_queue = None
+_ready_workers = set()
+_ready_lock = threading.Lock()
+progress_table = None
+manager = None
+embedding_cache = None
+mp_partial_dict = None
+mp_bbox_results_dict = None
+task_registry = None
+task_scheduler = None
+
+def init_pool(num_workers=INFERENCE_WORKERS, num_threads=INFERENCE_THREADS_PER_WORKER, start_method=INFERENCE_START_METHOD):
+    '''
+    num_workers, num_threads, start_method: same as create_inference_pool.
+    Creates progress table, task registry, task scheduler and inference pool 
+    of server. Called once by server before it starts serving requests.
+    '''
+    global pool, _num_workers, _ready_queue, progress_table, manager, embedding_cache, mp_partial_dict, mp_bbox_results_dict, task_registry, task_scheduler
+    # Progress table is created first, its shared memory block starts the resource 
+    # tracker which workers then inherit instead of starting their own.
+    progress_table = ProgressTable()
+    atexit.register(progress_table.close)
+    manager = SharedManager()
+    manager.start()
+    # One embedding cache for all workers, a repeated search hits it whichever worker runs it.
+    embedding_cache = manager.LRUCache(EMBEDDING_CACHE_MAX_BYTES)
+    # Partial results are written once or a few times per task, progress is kept in progress_table.
+    mp_partial_dict = manager.dict()
+    # Manager list of completed bbox results of every task, keyed by token in server.
+    mp_bbox_results_dict = {}
+    pool, _ready_queue, _num_workers = create_inference_pool(num_workers, num_threads, start_method, embedding_cache)
+    task_registry = TaskRegistry(progress_table, [mp_partial_dict, mp_bbox_results_dict])
+    task_registry.start_eviction()
+    task_scheduler = TaskScheduler(pool, _num_workers)
+
+def submit_task(func, *args, user=None, priority=DEFAULT_TASK_PRIORITY, cost=1, **kwargs):
+    '''
+    func: task function accepting a ProgressHandle as keyword argument progress 
+            and a PartialResult as keyword argument partial.
+    args, kwargs: arguments of func.
+    user: identity of user submitting task.
+    priority: name of priority class in TASK_PRIORITIES. Priorities above 
+            DEFAULT_TASK_PRIORITY are lowered to it unless user is in HIGH_PRIORITY_USERS.
+    cost: estimated cost of task, number of faces.
+    Queues func in task_scheduler with its own progress slot.
+    Returns: unique token of task or None if no progress slot is free.
+    '''
+    token = get_unique_id()
+    progress = progress_table.allocate(token)
+    if progress is None:
+        task_registry.evict()
+        progress = progress_table.allocate(token)
+        if progress is None:
+            return None
+    level = TASK_PRIORITIES.get(priority, TASK_PRIORITIES[DEFAULT_TASK_PRIORITY])
+    if level < TASK_PRIORITIES[DEFAULT_TASK_PRIORITY] and user not in HIGH_PRIORITY_USERS:
+        level = TASK_PRIORITIES[DEFAULT_TASK_PRIORITY]
+    mp_bbox_results_dict[token] = manager.list()
+    proc = task_scheduler.submit(
+        token, func, args, dict(kwargs, progress=progress, partial=PartialResult(mp_partial_dict, mp_bbox_results_dict[token], token, progress)), 
+        user, level, cost
+    )
+    task_registry.add(token, proc)
+    return token
+
+def cancel_task(token):
+    '''
+    token: unique process token generated when creating process.
+    Queued tasks are removed from task_scheduler, running tasks are flagged 
+    and stop at their next check.
+    Returns: True if task is cancelled, False if it is already completed 
+            or None if token is not valid.
+    '''
+    cancelled = progress_table.cancel(token)
+    if cancelled:
+        task_scheduler.cancel(token)
+    return cancelled
+
+def is_task_cancelled(token):
+    '''
+    token: unique process token generated when creating process.
+    Returns: True if task of token has been cancelled.
+    '''
+    return progress_table.is_cancelled(token)
+
+def get_partial_result(token):
+    '''
+    token: unique process token generated when creating process.
+    Returns: latest partial result published by task or None if there is none.
+    '''
+    # Manager is queried only once progress_table shows a result was published.
+    if not progress_table.partial_count(token):
+        return None
+    return mp_partial_dict.get(token)
 
-pool = Pool()
-manager = Manager()
-mp_progress_dict = manager.dict()
-mp_result_dict = dict()
+def get_partial_count(token):
+    '''
+    token: unique process token generated when creating process.
+    Returns: number of partial results published by task or None if token is not valid.
+    '''
+    return progress_table.partial_count(token)
+
+def get_queue_position(token):
+    '''
+    token: unique process token generated when creating process.
+    Returns: number of tasks that will be started before task of token 
+            or None if task is running, completed or token is not valid.
+    '''
+    return task_scheduler.queue_position(token)
 
 def get_progress(token):
     '''
@@ -15,43 +539,92 @@ def get_progress(token):
     Returns: float value representing the progress of process in [0, 1] 
             or None if token is not valid.
     '''
-    try:
-        return mp_progress_dict[token]
-    except KeyError:
-        return None
+    return progress_table.get_progress(token)
 
 def get_result(token):
     '''
     token: unique process token generated when creating process.
     Returns: Result of process if process is completed else False 
             or None if token is not valid.
+    Raises TaskFailed if task raised an error.
     '''
     try:
-        return mp_result_dict[token].get(timeout=0.1)
+        proc = task_registry[token]
+    except KeyError:
+        return None
+    try:
+        return proc.get(timeout=0.1)
     except TimeoutError:
         return False
+    except Exception as e:
+        raise TaskFailed(repr(e)) from e
+
+def get_incremental_result(token, cursor):
+    '''
+    token: unique process token generated when creating process.
+    cursor: number of bbox results already received.
+    Returns: A tuple of (results, cursor, completed) where results are the results 
+            of bboxes completed after cursor in bbox order, cursor is the cursor for 
+            next call and completed is True once task is completed, 
+            None if token is not valid or False if task failed or was cancelled.
+    '''
+    try:
+        proc = task_registry[token]
     except KeyError:
         return None
+    if proc.ready():
+        try:
+            results = proc.get()[cursor:]
+        except Exception:
+            return False
+        return results, cursor + len(results), True
+    # Manager is queried only once progress_table shows bboxes completed after cursor.
+    done = progress_table.get_done(token)
+    if not done or done <= cursor:
+        return [], cursor, False
+    bbox_results = mp_bbox_results_dict.get(token)
+    if bbox_results is None:
+        return [], cursor, False
+    results = bbox_results[cursor:done]
+    return results, cursor + len(results), False
 
-def delete_task(token):
+def get_eta(token):
     '''
     token: unique process token generated when creating process.
-    Returns: True if task is deleted else False.
+    Returns: estimated seconds until task is completed or None if it 
+            cannot be estimated yet or token is not valid.
+    '''
+    return progress_table.get_eta(token)
+
+def wait_task(token, timeout):
+    '''
+    token: unique process token generated when creating process.
+    timeout: maximum number of seconds to wait.
+    Blocks until task is completed or timeout expires.
+    Returns: True if task is completed else False or None if token is not valid.
     '''
     try:
-        del mp_progress_dict[token]
-        del mp_result_dict[token]
-        return True
+        proc = task_registry[token]
     except KeyError:
-        return False
+        return None
+    proc.wait(timeout)
+    return proc.ready()
+
+def delete_task(token):
+    '''
+    token: unique process token generated when creating process.
+    Returns: True if task is deleted else False.
+    '''
+    return task_registry.remove(token)
 
 def get_total_tasks():
     '''
-    Returns: A tuple of (total_tasks, completed_tasks)
+    Returns: A tuple of (total_tasks, completed_tasks) of retained tasks.
+    '''
+    return progress_table.counts()
+
+def get_evicted_tasks():
+    '''
+    Returns: number of tasks evicted from task_registry.
     '''
-    total_tasks = len(mp_progress_dict)
-    completed_tasks = 0
-    for k, v in mp_progress_dict.items():
-        if v == 1.0:
-            completed_tasks += 1
-    return (total_tasks, completed_tasks)
+    return task_registry.evicted
@@ -1,6 +1,45 @@
 import os
 
 FACE_MATCH_THRESHOLD = 0.5
+FACE_ENCODING_SIZE = 512 # VECTOR_SIZE of face_encoder, used for galleries without persons
 PERSON_DATA_PATH = os.path.join("data", "person_data")
 FACE_IMAGE_PATH = os.path.join("data", "face_image")
 STARRED_PERSON_COUNT_LIMIT = 50
+STARRED_PERSONS_TTL = 5 # seconds starred person ids are cached by each process
+EMBEDDING_STORE_PATH = os.path.join("data", "embedding_store")
+GALLERY_CHUNK_SIZE = 65536
+USE_ANN_INDEX = False
+ANN_INDEX_PATH = os.path.join("data", "ann_index.npz")
+ANN_NLIST = 1024
+ANN_NPROBE = 16
+GALLERY_COMPRESSION = None # None, "int8" or "pq"
+COMPRESSED_GALLERY_PATH = os.path.join("data", "compressed_gallery.npz")
+PQ_SUBSPACES = 64
+PQ_RESCORE_MARGIN = None # strict residual norm bound, a float caps it trading recall for speed (see benchmarks/bench_quantization.py)
+TILED_DETECTION_MIN_PIXELS = 12000000
+TILED_DETECTION_WORKERS = 1
+MAX_IMAGE_BYTES = 32*1024*1024
+MAX_REQUEST_BYTES = (MAX_IMAGE_BYTES + 2)//3*4 + 1024*1024 # base64 encoded image and other fields
+MAX_IMAGE_PIXELS = 50000000
+IMAGE_CACHE_MAX_BYTES = 512*1024*1024
+IMAGE_CACHE_TTL = 600
+EMBEDDING_CACHE_MAX_BYTES = 64*1024*1024
+PIPELINE_ENCODE_BATCH_SIZE = 8
+SEARCH_BLOCK_SIZE = 8 # bboxes searched per pass over gallery, results and progress are published per block
+STREAM_POLL_INTERVAL = 0.25
+TASK_TTL = 600
+MAX_RETAINED_TASKS = 1000
+TASK_EVICTION_INTERVAL = 30
+PROGRESS_TABLE_SLOTS = 4096
+INFERENCE_WORKERS = None # number of cpu cores if None
+INFERENCE_THREADS_PER_WORKER = None # cpu cores split evenly between workers if None
+INFERENCE_START_METHOD = "forkserver" # "fork" makes workers inherit models already loaded by server
+USE_BATCH_SCHEDULER = True
+DETECT_SCHEDULER_BATCH_SIZE = 8
+ENCODE_SCHEDULER_BATCH_SIZE = 32
+SCHEDULER_MAX_WAIT_MS = 5
+DETECT_EXECUTOR_THREADS = 16 # threads of asgi_app decoding and detecting images
+TASK_PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_TASK_PRIORITY = "normal"
+HIGH_PRIORITY_USERS = set() # users allowed to submit tasks above DEFAULT_TASK_PRIORITY
+ESTIMATED_FACES_PER_IMAGE = 8 # cost estimate of tasks which detect faces themselves
@@ -0,0 +1,207 @@
+import os
+import json
+import fcntl
+import argparse
+import contextlib
+import numpy as np
+
+from config import (
+    PERSON_DATA_PATH,
+    EMBEDDING_STORE_PATH
+)
+
+ENCODINGS_FILE = "encodings.f32"
+IDS_FILE = "ids.txt"
+META_FILE = "meta.json"
+LOCK_FILE = "append.lock"
+
+def l2_normalize(encodings):
+    '''
+    encodings: numpy array of shape D or NxD.
+    Returns: float32 array of same shape with every row scaled to unit length.
+    '''
+    encodings = np.asarray(encodings, dtype=np.float32)
+    norms = np.linalg.norm(encodings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return encodings/norms
+
+
+class EmbeddingStore(object):
+    '''
+    Append-only on-disk store of L2-normalised float32 face encodings.
+    Encodings are kept as a raw row-major float32 block that is memory-mapped
+    for reading, ids are kept one per line in the same order as rows.
+    '''
+    def __init__(self, path=EMBEDDING_STORE_PATH):
+        '''
+        path: directory of the store. It must have been created with create().
+        '''
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r") as f:
+            self.dim = json.load(f)["dim"]
+        with open(os.path.join(path, IDS_FILE), "r") as f:
+            self.ids = [line.rstrip("\n") for line in f if line.strip()]
+        self.index = {mid: row for row, mid in enumerate(self.ids)}
+
+    @classmethod
+    def create(cls, path, dim):
+        '''
+        path: directory in which new empty store is to be created.
+        dim: dimension of encodings.
+        Returns: EmbeddingStore instance of the new store.
+        '''
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump({"dim": dim}, f)
+        open(os.path.join(path, ENCODINGS_FILE), "wb").close()
+        open(os.path.join(path, IDS_FILE), "w").close()
+        return cls(path)
+
+    @staticmethod
+    def exists(path=EMBEDDING_STORE_PATH):
+        '''
+        Returns: True if a store is found at path else False.
+        '''
+        return os.path.exists(os.path.join(path, META_FILE))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    @staticmethod
+    def mtime(path=EMBEDDING_STORE_PATH):
+        '''
+        Returns: modification time of store at path, changes on every append.
+        '''
+        return os.stat(os.path.join(path, IDS_FILE)).st_mtime_ns
+
+    def encodings(self):
+        '''
+        Returns: read-only NxD memory-mapped array of encodings.
+        '''
+        if len(self.ids) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(
+            os.path.join(self.path, ENCODINGS_FILE),
+            dtype=np.float32,
+            mode="r",
+            shape=(len(self.ids), self.dim)
+        )
+
+    def get(self, id):
+        '''
+        id: id of person.
+        Returns: encoding of person or None if id is not in store.
+        '''
+        row = self.index.get(id)
+        if row is None:
+            return None
+        return np.array(self.encodings()[row])
+
+    def append(self, ids, encodings):
+        '''
+        ids: list of person ids to be enrolled.
+        encodings: numpy array of shape NxD holding one encoding per id.
+        Rows are written before ids so an interrupted append never exposes
+        an id without its encoding.
+        Returns: number of encodings appended.
+        '''
+        encodings = l2_normalize(encodings).reshape(len(ids), self.dim)
+        for mid in ids:
+            if mid in self.index:
+                raise ValueError("id {} is already enrolled".format(mid))
+        with open(os.path.join(self.path, ENCODINGS_FILE), "r+b") as f:
+            f.seek(len(self.ids)*self.dim*4)
+            f.write(encodings.astype("<f4").tobytes())
+            f.truncate()
+        with open(os.path.join(self.path, IDS_FILE), "a") as f:
+            for mid in ids:
+                f.write(mid + "\n")
+        for mid in ids:
+            self.index[mid] = len(self.ids)
+            self.ids.append(mid)
+        return len(ids)
+
+
+def convert_person_data(person_data_path=PERSON_DATA_PATH, store_path=EMBEDDING_STORE_PATH, batch_size=1024):
+    '''
+    person_data_path: directory containing person json files.
+    store_path: directory of store to be created or extended.
+    batch_size: number of encodings written per append.
+    Returns: EmbeddingStore containing encodings of every person json.
+            Persons already in store are skipped.
+    '''
+    store = EmbeddingStore(store_path) if EmbeddingStore.exists(store_path) else None
+    pending = set()
+    ids = []
+    encodings = []
+    for person_data_name in sorted(os.listdir(person_data_path)):
+        # Person json files are named after the id of the person.
+        if store is not None and os.path.splitext(person_data_name)[0] in store:
+            continue
+        with open(os.path.join(person_data_path, person_data_name), "r") as f:
+            person_data = json.load(f)
+        if store is None:
+            store = EmbeddingStore.create(store_path, len(person_data["face_encoding"]))
+        if person_data["id"] in store or person_data["id"] in pending:
+            continue
+        pending.add(person_data["id"])
+        ids.append(person_data["id"])
+        encodings.append(person_data["face_encoding"])
+        if len(ids) == batch_size:
+            store.append(ids, np.array(encodings))
+            ids, encodings = [], []
+    if len(ids) > 0:
+        store.append(ids, np.array(encodings))
+    return store
+
+
+@contextlib.contextmanager
+def store_lock(store_path, operation):
+    '''
+    store_path: directory of an existing store.
+    operation: fcntl.LOCK_EX to append to store or fcntl.LOCK_SH to read it.
+    Holds lock file of store for the duration of the with block.
+    '''
+    with open(os.path.join(store_path, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_store(store_path=EMBEDDING_STORE_PATH):
+    '''
+    store_path: directory of an existing store.
+    Reads store under a shared lock, so that ids are never read while a 
+    process is partway through appending them.
+    Returns: EmbeddingStore instance.
+    '''
+    with store_lock(store_path, fcntl.LOCK_SH):
+        return EmbeddingStore(store_path)
+
+
+def sync_person_data(person_data_path=PERSON_DATA_PATH, store_path=EMBEDDING_STORE_PATH):
+    '''
+    person_data_path: directory containing person json files.
+    store_path: directory of an existing store.
+    Appends persons enrolled as json files after the store was built. Holds
+    an exclusive lock on the store meanwhile so that processes syncing at
+    the same time never append the same person twice.
+    Returns: number of encodings appended.
+    '''
+    with store_lock(store_path, fcntl.LOCK_EX):
+        count = len(EmbeddingStore(store_path))
+        return len(convert_person_data(person_data_path, store_path)) - count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert person json files to binary embedding store")
+    parser.add_argument("--person_data_path", default=PERSON_DATA_PATH)
+    parser.add_argument("--store_path", default=EMBEDDING_STORE_PATH)
+    args = parser.parse_args()
+    store = convert_person_data(args.person_data_path, args.store_path)
+    print("{} encodings in store {}".format(len(store), args.store_path))
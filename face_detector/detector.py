@@ -1,9 +1,11 @@
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import numpy as np
-from .layers.functions.prior_box import PriorBox
-from .utils.nms.py_cpu_nms import py_cpu_nms
+from .layers.functions.prior_box import get_priors
+from .utils.nms.fast_nms import cpu_nms, torch_nms, batched_nms
+from .utils.timer import Timer
 from .models.retinaface import RetinaFace
 from .utils.box_utils import decode, decode_landm
 
@@ -49,65 +51,287 @@ del state_dict
 net.eval()
 resize = 1
 
-def detect_faces(img):
-    with torch.no_grad():
-        im_height, im_width, _ = img.shape
-        scale = torch.Tensor([img.shape[1], img.shape[0], img.shape[1], img.shape[0]])
-        img = img.transpose(2, 0, 1)
-        img = torch.from_numpy(img.astype(np.float32)).unsqueeze(0)
-        img = img.to(device)
-        scale = scale.to(device)
-        loc, conf, landms = net(img)  # forward pass
-        priorbox = PriorBox(cfg, image_size=(im_height, im_width))
-        priors = priorbox.forward()
-        priors = priors.to(device)
-        prior_data = priors.data
-        boxes = decode(loc.data.squeeze(0), prior_data, cfg['variance'])
-        boxes = boxes * scale / resize
-        boxes = boxes.cpu().numpy()
-        scores = conf.squeeze(0).data.cpu().numpy()[:, 1]
-        landms = decode_landm(landms.data.squeeze(0), prior_data, cfg['variance'])
-        scale1 = torch.Tensor([
-            img.shape[3], img.shape[2], img.shape[3], img.shape[2],
-            img.shape[3], img.shape[2], img.shape[3], img.shape[2],
-            img.shape[3], img.shape[2]]
-        )
-        scale1 = scale1.to(device)
-        landms = landms * scale1 / resize
-        landms = landms.cpu().numpy()
+DETECT_BATCH_SIZE = 8
+DETECT_TILE_SIZE = 1024
+DETECT_TILE_OVERLAP = 256
+
+class _Stage(object):
+    '''
+    Context manager adding time spent in a block to timers[name].
+    Does nothing when timers is None.
+    '''
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        if self.timers is not None:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            self.timers.setdefault(self.name, Timer()).tic()
+
+    def __exit__(self, *exc):
+        if self.timers is not None:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            self.timers[self.name].toc()
+
+
+def _visible(dets):
+    '''
+    Returns: boolean mask of detections that pass vis_thres and are at least
+            56 pixels wide and high.
+    '''
+    b = np.trunc(dets[:, :4]).astype(np.int64)
+    w, h = (b[:, 2]-b[:, 0]), (b[:, 3]-b[:, 1])
+    return (dets[:, 4] >= args.vis_thres) & (w >= 56) & (h >= 56)
+
+
+def _format_bboxes(dets, im_height, im_width):
+    '''
+    dets: numpy array of shape Nx5 of (x1, y1, x2, y2, score) after NMS.
+    Returns: list of square bboxes (x1, y1, x2, y2) enlarged by 20% around
+            faces that pass vis_thres and are at least 56 pixels wide and high.
+    '''
+    b = np.trunc(dets[:, :4]).astype(np.int64)[_visible(dets)]
+    x1, y1, x2, y2 = b[:, 0], b[:, 1], b[:, 2], b[:, 3]
+    w, h = (x2-x1), (y2-y1)
+    cx, cy = x1+(w//2), y1+(h//2)
+    s = np.trunc(1.2*np.maximum(w, h)).astype(np.int64)
+    x1, y1 = np.maximum(0, cx-(s//2)), np.maximum(0, cy-(s//2))
+    x2, y2 = np.minimum(im_width, cx+(s//2)), np.minimum(im_height, cy+(s//2))
+    return [tuple(map(int, bbox)) for bbox in zip(x1, y1, x2, y2)]
+
+
+def _format_landmarks(dets):
+    '''
+    dets: numpy array of shape Nx15 of detections with landmarks after NMS.
+    Returns: list of 5 (x, y) landmarks for every bbox of _format_bboxes.
+    '''
+    landms = dets[_visible(dets), 5:15].reshape(-1, 5, 2)
+    return [[tuple(map(float, point)) for point in face] for face in landms]
+
+
+def _decode_dets(loc, conf, landms, prior_data, im_height, im_width, return_landmarks=False, timers=None):
+    '''
+    loc, conf, landms: network outputs of a single image without batch dimension.
+    prior_data: priors of image size on device.
+    return_landmarks: decode landmarks of kept boxes as well.
+    timers: optional dict of Timer per stage.
+    Scores are thresholded on device and only surviving priors are decoded.
+    Returns: tensor on device of shape Nx5 of (x1, y1, x2, y2, score) before NMS,
+            or Nx15 with 5 (x, y) landmarks appended if return_landmarks is set.
+    '''
+    with _Stage(timers, "filter"):
         # ignore low scores
-        inds = np.where(scores > args.confidence_threshold)[0]
-        boxes = boxes[inds]
-        landms = landms[inds]
-        scores = scores[inds]
+        scores = conf[:, 1]
+        inds = torch.nonzero(scores > args.confidence_threshold).squeeze(1)
         # keep top-K before NMS
-        order = scores.argsort()[::-1][:args.top_k]
-        boxes = boxes[order]
-        landms = landms[order]
-        scores = scores[order]
-        # do NMS
-        dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
-        keep = py_cpu_nms(dets, args.nms_threshold)
-        # keep = nms(dets, args.nms_threshold,force_cpu=args.cpu)
+        scores, order = scores[inds].sort(descending=True)
+        scores = scores[:args.top_k]
+        inds = inds[order[:args.top_k]]
+        priors = prior_data[inds]
+    with _Stage(timers, "decode"):
+        scale = torch.Tensor([im_width, im_height, im_width, im_height])
+        scale = scale.to(device)
+        boxes = decode(loc[inds], priors, cfg['variance'])
+        boxes = boxes * scale / resize
+        dets = [boxes, scores.unsqueeze(1)]
+        if return_landmarks:
+            scale1 = torch.Tensor([
+                im_width, im_height, im_width, im_height,
+                im_width, im_height, im_width, im_height,
+                im_width, im_height]
+            )
+            scale1 = scale1.to(device)
+            dets.append(decode_landm(landms[inds], priors, cfg['variance']) * scale1 / resize)
+        dets = torch.cat(dets, dim=1)
+    return dets
+
+
+def _postprocess(loc, conf, landms, prior_data, im_height, im_width, return_landmarks=False, timers=None):
+    '''
+    loc, conf, landms: network outputs of a single image without batch dimension.
+    prior_data: priors of image size on device.
+    return_landmarks: decode landmarks of kept boxes as well.
+    timers: optional dict of Timer per stage.
+    Detections are decoded on device and copied to host once.
+    Returns: numpy array of shape Nx5 of (x1, y1, x2, y2, score) after NMS,
+            or Nx15 with 5 (x, y) landmarks appended if return_landmarks is set.
+    '''
+    dets = _decode_dets(loc, conf, landms, prior_data, im_height, im_width, return_landmarks, timers)
+    # do NMS, on device when it is a GPU so that only kept boxes are copied
+    if device.type == "cuda":
+        with _Stage(timers, "nms"):
+            keep = torch_nms(dets[:, :4], dets[:, 4], args.nms_threshold, args.keep_top_k)
+            dets = dets[keep]
+        with _Stage(timers, "copy"):
+            dets = dets.cpu().numpy()
+        return dets
+    with _Stage(timers, "copy"):
+        dets = dets.cpu().numpy()
+    with _Stage(timers, "nms"):
+        keep = cpu_nms(dets, args.nms_threshold, args.keep_top_k)
         dets = dets[keep, :]
-        landms = landms[keep]
-        # keep top-K faster NMS
-        dets = dets[:args.keep_top_k, :]
-        landms = landms[:args.keep_top_k, :]
-        dets = np.concatenate((dets, landms), axis=1)
-        result = []
-        for b in dets:
-            if b[4] < args.vis_thres:
-                continue
-            b = list(map(int, b))
-            x1, y1, x2, y2 = b[0], b[1], b[2], b[3]
-            w, h = (x2-x1), (y2-y1)
-            if w < 56 or h < 56:
-                continue
-            cx, cy = x1+(w//2), y1+(h//2)
-            w, h = max(w, h), max(w, h)
-            w, h = int(1.2*w), int(1.2*h)
-            x1, y1 = max(0, cx-(w//2)), max(0, cy-(h//2))
-            x2, y2 = min(im_width, cx+(w//2)), min(im_height, cy+(h//2))
-            result.append((x1, y1, x2, y2))
-    return result
+    return dets
+
+
+def _detect_dets_batch(imgs, batch_size=DETECT_BATCH_SIZE, return_landmarks=False, timers=None):
+    '''
+    imgs: list of numpy arrays of shape HxWx3.
+    batch_size: maximum number of images stacked into one forward pass.
+    return_landmarks: decode landmarks of kept boxes as well.
+    timers: optional dict of Timer per stage.
+    Images are grouped by shape so that every forward pass runs on a stack
+    of equally shaped images and priors are fetched once per size.
+    Returns: list holding array of detections after NMS for every image.
+    '''
+    results = [None]*len(imgs)
+    groups = {}
+    for i, img in enumerate(imgs):
+        groups.setdefault(img.shape, []).append(i)
+    with torch.no_grad():
+        for shape, inds in groups.items():
+            im_height, im_width = shape[:2]
+            prior_data = get_priors(cfg, (im_height, im_width), device)
+            for start in range(0, len(inds), batch_size):
+                batch_inds = inds[start:start+batch_size]
+                with _Stage(timers, "forward"):
+                    batch = np.stack([imgs[i] for i in batch_inds]).transpose(0, 3, 1, 2)
+                    batch = torch.from_numpy(batch.astype(np.float32))
+                    batch = batch.to(device)
+                    loc, conf, landms = net(batch)  # forward pass
+                if len(batch_inds) == 1:
+                    results[batch_inds[0]] = _postprocess(
+                        loc[0], conf[0], landms[0], prior_data, im_height, im_width, 
+                        return_landmarks, timers
+                    )
+                    continue
+                dets = [
+                    _decode_dets(loc[j], conf[j], landms[j], prior_data, im_height, im_width, return_landmarks, timers)
+                    for j in range(len(batch_inds))
+                ]
+                for i, image_dets in zip(batch_inds, _batched_postprocess(dets, timers)):
+                    results[i] = image_dets
+    return results
+
+
+def _batched_postprocess(dets, timers=None):
+    '''
+    dets: list of tensors on device of decoded detections of every image.
+    timers: optional dict of Timer per stage.
+    Runs NMS of all images in one batched_nms pass, on device, and copies 
+    kept detections to host once.
+    Returns: list holding numpy array of detections after NMS for every image 
+            in decreasing score order.
+    '''
+    with _Stage(timers, "nms"):
+        sizes = torch.tensor([len(d) for d in dets], device=device)
+        idxs = torch.repeat_interleave(torch.arange(len(dets), device=device), sizes)
+        dets = torch.cat(dets)
+        keep = batched_nms(dets[:, :4], dets[:, 4], idxs, args.nms_threshold, args.keep_top_k)
+    with _Stage(timers, "copy"):
+        dets = dets[keep].cpu().numpy()
+        idxs = idxs[keep].cpu().numpy()
+    return [dets[idxs == j] for j in range(len(sizes))]
+
+
+def detect_faces(img, return_landmarks=False, timers=None):
+    return detect_faces_batch([img], return_landmarks=return_landmarks, timers=timers)[0]
+
+
+def detect_faces_batch(imgs, batch_size=DETECT_BATCH_SIZE, return_landmarks=False, timers=None):
+    '''
+    imgs: list of numpy arrays of shape HxWx3.
+    batch_size: maximum number of images stacked into one forward pass.
+    return_landmarks: also return 5 landmarks of every face.
+    timers: optional dict, filled with a Timer per detection stage.
+    Returns: list holding list of bounding boxes for every image, or
+            (bboxes, landmarks) for every image if return_landmarks is set.
+    '''
+    results = _detect_dets_batch(imgs, batch_size, return_landmarks, timers)
+    out = []
+    for img, dets in zip(imgs, results):
+        bboxes = _format_bboxes(dets, img.shape[0], img.shape[1])
+        out.append((bboxes, _format_landmarks(dets)) if return_landmarks else bboxes)
+    return out
+
+
+def _tile_starts(size, tile_size, overlap):
+    '''
+    Returns: start offsets of tiles covering [0, size) where neighbouring
+            tiles share overlap pixels and last tile ends at size.
+    '''
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+
+def _merge_tile_dets(dets, seams):
+    '''
+    dets: numpy array of shape Nx5 of detections of all tiles in image coordinates.
+    seams: boolean array of N, True for boxes touching an inner tile edge.
+    Returns: detections left after NMS across tiles. A box touching a seam is
+            a face cut by its tile, it is dropped when more than half of it
+            lies inside a box that does not touch a seam.
+    '''
+    # Boxes under vis_thres are dropped by _format_bboxes and can never
+    # suppress a higher scored box, so they are removed before merging.
+    visible = dets[:, 4] >= args.vis_thres
+    dets, seams = dets[visible], seams[visible]
+    whole, cut = dets[~seams], dets[seams]
+    if len(whole) > 0 and len(cut) > 0:
+        lt = np.maximum(cut[:, np.newaxis, :2], whole[np.newaxis, :, :2])
+        rb = np.minimum(cut[:, np.newaxis, 2:4], whole[np.newaxis, :, 2:4])
+        inter = np.prod(np.maximum(rb - lt + 1, 0), axis=2)
+        area = np.prod(cut[:, 2:4] - cut[:, :2] + 1, axis=1)
+        contained = (inter/area[:, np.newaxis] > 0.5).any(axis=1)
+        dets = np.concatenate((whole, cut[~contained]))
+    keep = cpu_nms(dets, args.nms_threshold, args.keep_top_k)
+    return dets[keep]
+
+
+def detect_faces_tiled(img, tile_size=DETECT_TILE_SIZE, overlap=DETECT_TILE_OVERLAP, workers=1):
+    '''
+    img: numpy array of shape HxWx3.
+    tile_size: side of square tiles the image is split into.
+    overlap: pixels shared by neighbouring tiles, faces smaller than this
+             are seen whole by at least one tile.
+    workers: number of tiles detected in parallel.
+    Peak activation memory is bounded by workers tiles instead of the image.
+    Returns: list of bounding boxes of format (x1, y1, x2, y2).
+    '''
+    im_height, im_width, _ = img.shape
+    tiles = [
+        (y0, x0, min(y0 + tile_size, im_height), min(x0 + tile_size, im_width))
+        for y0 in _tile_starts(im_height, tile_size, overlap)
+        for x0 in _tile_starts(im_width, tile_size, overlap)
+    ]
+
+    def detect_tile(tile):
+        y0, x0, y1, x1 = tile
+        dets = _detect_dets_batch([img[y0:y1, x0:x1]])[0].copy()
+        dets[:, :4] += (x0, y0, x0, y0)
+        # Edges of a tile that are not edges of image cut faces in two.
+        seams = np.zeros(len(dets), dtype=bool)
+        if x0 > 0:
+            seams |= dets[:, 0] <= x0 + 1
+        if y0 > 0:
+            seams |= dets[:, 1] <= y0 + 1
+        if x1 < im_width:
+            seams |= dets[:, 2] >= x1 - 2
+        if y1 < im_height:
+            seams |= dets[:, 3] >= y1 - 2
+        return dets, seams
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outputs = list(executor.map(detect_tile, tiles))
+    else:
+        outputs = [detect_tile(tile) for tile in tiles]
+    dets = np.concatenate([out[0] for out in outputs])
+    seams = np.concatenate([out[1] for out in outputs])
+    return _format_bboxes(_merge_tile_dets(dets, seams), im_height, im_width)
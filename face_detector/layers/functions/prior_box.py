@@ -1,8 +1,11 @@
 import torch
-from itertools import product as product
+import threading
+from collections import OrderedDict
 import numpy as np
 from math import ceil
 
+PRIOR_CACHE_SIZE = 16
+
 
 class PriorBox(object):
     def __init__(self, cfg, image_size=None, phase='train'):
@@ -14,21 +17,55 @@ class PriorBox(object):
         self.feature_maps = [[ceil(self.image_size[0]/step), ceil(self.image_size[1]/step)] for step in self.steps]
         self.name = "s"
 
-    def forward(self):
+    def anchors(self):
+        """Anchors as a float64 numpy array of shape [num_priors, 4] in
+        (cx, cy, s_kx, s_ky) form, ordered by feature map, row, column
+        and min size.
+        """
         anchors = []
         for k, f in enumerate(self.feature_maps):
-            min_sizes = self.min_sizes[k]
-            for i, j in product(range(f[0]), range(f[1])):
-                for min_size in min_sizes:
-                    s_kx = min_size / self.image_size[1]
-                    s_ky = min_size / self.image_size[0]
-                    dense_cx = [x * self.steps[k] / self.image_size[1] for x in [j + 0.5]]
-                    dense_cy = [y * self.steps[k] / self.image_size[0] for y in [i + 0.5]]
-                    for cy, cx in product(dense_cy, dense_cx):
-                        anchors += [cx, cy, s_kx, s_ky]
+            min_sizes = np.array(self.min_sizes[k], dtype=np.float64)
+            cx = (np.arange(f[1]) + 0.5) * self.steps[k] / self.image_size[1]
+            cy = (np.arange(f[0]) + 0.5) * self.steps[k] / self.image_size[0]
+            out = np.empty((f[0], f[1], len(min_sizes), 4), dtype=np.float64)
+            out[..., 0] = cx[np.newaxis, :, np.newaxis]
+            out[..., 1] = cy[:, np.newaxis, np.newaxis]
+            out[..., 2] = min_sizes / self.image_size[1]
+            out[..., 3] = min_sizes / self.image_size[0]
+            anchors.append(out.reshape(-1, 4))
+        return np.concatenate(anchors)
 
+    def forward(self):
         # back to torch land
-        output = torch.Tensor(anchors).view(-1, 4)
+        output = torch.from_numpy(self.anchors().astype(np.float32))
         if self.clip:
             output.clamp_(max=1, min=0)
         return output
+
+
+_prior_cache = OrderedDict()
+_prior_cache_lock = threading.Lock()
+
+def get_priors(cfg, image_size, device):
+    """Priors of an image size on device, kept in a LRU cache of
+    PRIOR_CACHE_SIZE entries keyed by (height, width, device).
+    Args:
+        cfg: network config holding min_sizes, steps and clip.
+        image_size: (height, width) of image.
+        device: torch device the priors are used on.
+    Return:
+        priors (tensor), Shape: [num_priors, 4]. It is shared between
+        callers and must not be modified in place.
+    """
+    key = (cfg['name'], image_size[0], image_size[1], str(device))
+    with _prior_cache_lock:
+        if key in _prior_cache:
+            _prior_cache.move_to_end(key)
+            return _prior_cache[key]
+    priors = PriorBox(cfg, image_size=image_size).forward().to(device)
+    with _prior_cache_lock:
+        _prior_cache[key] = priors
+        _prior_cache.move_to_end(key)
+        while len(_prior_cache) > PRIOR_CACHE_SIZE:
+            _prior_cache.popitem(last=False)
+    return priors
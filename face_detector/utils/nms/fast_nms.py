@@ -0,0 +1,135 @@
+import torch
+import torchvision
+import numpy as np
+
+
+def cpu_nms(dets, thresh, keep_top_k=None):
+    """Greedy NMS in NumPy with the same +1 pixel convention as py_cpu_nms,
+    which stops as soon as keep_top_k boxes are kept instead of suppressing
+    the whole list and slicing afterwards.
+    Args:
+        dets: (ndarray) boxes and scores, Shape: [N, 5].
+        thresh: (float) IoU above which a box is suppressed.
+        keep_top_k: (int) maximum number of boxes to keep, None keeps all.
+    Return:
+        list of indices of kept boxes in decreasing score order.
+    """
+    if keep_top_k is None:
+        keep_top_k = len(dets)
+    x1 = dets[:, 0]
+    y1 = dets[:, 1]
+    x2 = dets[:, 2]
+    y2 = dets[:, 3]
+    scores = dets[:, 4]
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0 and len(keep) < keep_top_k:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        xx1 = np.maximum(x1[i], x1[rest])
+        yy1 = np.maximum(y1[i], y1[rest])
+        xx2 = np.minimum(x2[i], x2[rest])
+        yy2 = np.minimum(y2[i], y2[rest])
+
+        w = np.maximum(0.0, xx2 - xx1 + 1)
+        h = np.maximum(0.0, yy2 - yy1 + 1)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[rest] - inter)
+        order = rest[ovr <= thresh]
+
+    return keep
+
+
+def _plus_one(boxes):
+    """Boxes whose x2 and y2 are moved by one pixel, so that the continuous
+    IoU of torchvision.ops equals the +1 pixel IoU of py_cpu_nms.
+    """
+    return torch.cat((boxes[:, :2], boxes[:, 2:4] + 1), dim=1)
+
+
+def torch_nms(boxes, scores, thresh, keep_top_k=None):
+    """NMS on tensors with the +1 pixel convention of py_cpu_nms, run by
+    torchvision.ops.nms so that boxes are suppressed on device without a
+    host sync per kept box.
+    Args:
+        boxes: (tensor) boxes in point form, Shape: [N, 4].
+        scores: (tensor) scores of boxes, Shape: [N].
+        thresh: (float) IoU above which a box is suppressed.
+        keep_top_k: (int) maximum number of boxes to keep, None keeps all.
+    Return:
+        (tensor) long indices of kept boxes in decreasing score order.
+    """
+    keep = torchvision.ops.nms(_plus_one(boxes), scores, thresh)
+    return keep if keep_top_k is None else keep[:keep_top_k]
+
+
+def torch_nms_reference(boxes, scores, thresh, keep_top_k=None):
+    """Greedy NMS on tensors written as a Python loop, kept as a reference
+    for torch_nms. On CUDA every kept box costs a device to host sync.
+    Args:
+        boxes: (tensor) boxes in point form, Shape: [N, 4].
+        scores: (tensor) scores of boxes, Shape: [N].
+        thresh: (float) IoU above which a box is suppressed.
+        keep_top_k: (int) maximum number of boxes to keep, None keeps all.
+    Return:
+        (tensor) long indices of kept boxes in decreasing score order.
+    """
+    if keep_top_k is None:
+        keep_top_k = boxes.size(0)
+    if boxes.numel() == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device)
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort(descending=True)
+
+    keep = []
+    while order.numel() > 0 and len(keep) < keep_top_k:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        xx1 = torch.max(x1[i], x1[rest])
+        yy1 = torch.max(y1[i], y1[rest])
+        xx2 = torch.min(x2[i], x2[rest])
+        yy2 = torch.min(y2[i], y2[rest])
+
+        w = torch.clamp(xx2 - xx1 + 1, min=0.0)
+        h = torch.clamp(yy2 - yy1 + 1, min=0.0)
+        inter = w * h
+        ovr = inter / (areas[i] + areas[rest] - inter)
+        order = rest[ovr <= thresh]
+
+    if len(keep) == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device)
+    return torch.stack(keep)
+
+
+def batched_nms(boxes, scores, idxs, thresh, keep_top_k=None):
+    """NMS over boxes of several images (or classes) in one
+    torchvision.ops.batched_nms pass, with the +1 pixel convention of
+    py_cpu_nms and keep_top_k applied per group.
+    Args:
+        boxes: (tensor) boxes in point form, Shape: [N, 4].
+        scores: (tensor) scores of boxes, Shape: [N].
+        idxs: (tensor) group index of every box, Shape: [N].
+        thresh: (float) IoU above which a box is suppressed.
+        keep_top_k: (int) maximum number of boxes kept per group, None keeps all.
+    Return:
+        (tensor) long indices of kept boxes in decreasing score order.
+    """
+    if boxes.numel() == 0:
+        return torch.zeros(0, dtype=torch.long, device=boxes.device)
+    keep = torchvision.ops.batched_nms(_plus_one(boxes), scores, idxs, thresh)
+    if keep_top_k is None:
+        return keep
+    # Kept boxes are in decreasing score order, so a stable sort by group
+    # keeps score order within each group and rank is position in group.
+    group_idxs, order = torch.sort(idxs[keep], stable=True)
+    _, counts = torch.unique_consecutive(group_idxs, return_counts=True)
+    starts = torch.cumsum(counts, dim=0) - counts
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(order.numel(), device=order.device) - torch.repeat_interleave(starts, counts)
+    return keep[rank < keep_top_k]
@@ -6,6 +6,7 @@ from .resnet import ResNet50
 
 FACE_IMAGE_SIZE = 112
 VECTOR_SIZE = 512
+ENCODE_BATCH_SIZE = 32
 FACE_ENCODER_DIR = os.path.join("face_encoder", "saved_models", "ArcFace-ResNet50.pt")
 FACE_ENCODER_MODEL = ResNet50
 
@@ -14,7 +15,7 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 face_transforms = tv.transforms.Compose([
     tv.transforms.ToPILImage(), 
-    tv.transforms.Resize(FACE_IMAGE_SIZE), 
+    tv.transforms.Resize((FACE_IMAGE_SIZE, FACE_IMAGE_SIZE)), 
     tv.transforms.ToTensor(), 
     tv.transforms.Normalize(mean=[127.5]*3, std=[128.0]*3)
 ])
@@ -27,9 +28,21 @@ def encode_face(img):
     args:
         img: numpy array
     '''
-    img = face_transforms(img)
-    img = img.to(device).unsqueeze(0)
-    with torch.no_grad():
-        encoding = face_encoder(img)
-    encoding = encoding.squeeze(0).cpu().numpy()
-    return encoding
+    return encode_faces([img])[0]
+
+
+def encode_faces(imgs, batch_size=ENCODE_BATCH_SIZE):
+    '''
+    args:
+        imgs: list of numpy arrays
+        batch_size: number of faces stacked into one forward pass
+    returns:
+        numpy array of shape (N, VECTOR_SIZE)
+    '''
+    encodings = np.zeros((len(imgs), VECTOR_SIZE), dtype=np.float32)
+    for start in range(0, len(imgs), batch_size):
+        batch = torch.stack([face_transforms(img) for img in imgs[start:start+batch_size]])
+        batch = batch.to(device)
+        with torch.no_grad():
+            encodings[start:start+len(batch)] = face_encoder(batch).cpu().numpy()
+    return encodings
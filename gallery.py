@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import numpy as np
+
+from embedding_store import (
+    EmbeddingStore,
+    load_store,
+    l2_normalize,
+    sync_person_data
+)
+from ann_index import IVFIndex
+from quantization import CompressedIndex
+from db.utils import get_starred_persons
+from config import (
+    FACE_MATCH_THRESHOLD,
+    FACE_ENCODING_SIZE,
+    PERSON_DATA_PATH,
+    STARRED_PERSON_COUNT_LIMIT,
+    STARRED_PERSONS_TTL,
+    EMBEDDING_STORE_PATH,
+    GALLERY_CHUNK_SIZE,
+    USE_ANN_INDEX,
+    ANN_INDEX_PATH,
+    GALLERY_COMPRESSION,
+    COMPRESSED_GALLERY_PATH
+)
+
+class Gallery(object):
+    '''
+    Matrix of L2-normalised face encodings of all known persons.
+    Row i of encodings belongs to person ids[i]. The matrix is either resident
+    in memory or memory-mapped from an EmbeddingStore.
+    '''
+    def __init__(self, ids, encodings, normalized=False):
+        '''
+        ids: list of person ids.
+        encodings: numpy array of shape NxD holding one encoding per id.
+        normalized: True if rows of encodings already have unit length,
+                    memory-mapped arrays are then used without copying.
+        '''
+        self.ids = np.array(ids, dtype=object)
+        self.index = None
+        if normalized:
+            self.encodings = encodings
+        else:
+            self.encodings = np.ascontiguousarray(l2_normalize(encodings).reshape(len(ids), -1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def empty(cls, dim):
+        '''
+        dim: dimension of encodings.
+        Returns: Gallery without persons whose search matches nobody.
+        '''
+        return cls([], np.zeros((0, dim), dtype=np.float32), normalized=True)
+
+    @classmethod
+    def from_person_data(cls, person_data_path=PERSON_DATA_PATH):
+        '''
+        person_data_path: directory containing person json files.
+        Returns: Gallery built from face_encoding field of every person json.
+        '''
+        ids = []
+        encodings = []
+        for person_data_name in sorted(os.listdir(person_data_path)):
+            with open(os.path.join(person_data_path, person_data_name), "r") as f:
+                person_data = json.load(f)
+            ids.append(person_data["id"])
+            encodings.append(np.array(person_data["face_encoding"], dtype=np.float32))
+        if len(encodings) == 0:
+            return cls.empty(FACE_ENCODING_SIZE)
+        return cls(ids, np.stack(encodings))
+
+    @classmethod
+    def from_store(cls, store_path=EMBEDDING_STORE_PATH):
+        '''
+        store_path: directory of EmbeddingStore.
+        Returns: Gallery backed by memory-mapped encodings of the store.
+        '''
+        store = load_store(store_path)
+        return cls(store.ids, store.encodings(), normalized=True)
+
+    def attach_index(self, index):
+        '''
+        index: IVFIndex or CompressedIndex built over this gallery.
+        Returns: True if index is attached, False if it does not cover the
+                gallery row for row (e.g. persons were enrolled after it
+                was built or the gallery was rebuilt in another order).
+        '''
+        if len(index) != len(self) or not np.array_equal(index.ids, self.ids):
+            self.index = None
+            return False
+        self.index = index
+        return True
+
+    def subset(self, ids):
+        '''
+        ids: person ids to be kept.
+        Returns: Gallery resident in memory holding rows of ids found in this gallery.
+        '''
+        rows = np.where(np.isin(self.ids, list(ids)))[0]
+        if len(rows) == 0:
+            return Gallery.empty(self.encodings.shape[1])
+        return Gallery(self.ids[rows].tolist(), np.array(self.encodings[rows]), normalized=True)
+
+    def scores(self, encodings):
+        '''
+        encodings: numpy array of shape D or QxD of query face encodings.
+        Returns: QxN array of cosine similarity of each query with each person.
+        '''
+        queries = l2_normalize(encodings).reshape(-1, self.encodings.shape[1])
+        return queries @ self.encodings.T
+
+    def search(self, encodings, threshold=FACE_MATCH_THRESHOLD, check=None):
+        '''
+        encodings: numpy array of shape D or QxD of query face encodings.
+        threshold: minimum cosine similarity for a person to be matched.
+        check: function called between chunks which raises to stop search.
+        Returns: list of Q lists of matched person ids sorted by decreasing similarity.
+        Gallery is scanned in chunks of GALLERY_CHUNK_SIZE rows so that a
+        memory-mapped gallery is never loaded into memory as a whole. If an
+        index is attached the search is delegated to it.
+        '''
+        if self.index is not None:
+            return self.index.search(encodings, threshold, check=check)
+        if len(self) == 0:
+            return [[] for _ in range(np.atleast_2d(encodings).shape[0])]
+        queries = l2_normalize(encodings).reshape(-1, self.encodings.shape[1])
+        matched_inds = [[] for _ in range(len(queries))]
+        matched_scores = [[] for _ in range(len(queries))]
+        for start in range(0, len(self), GALLERY_CHUNK_SIZE):
+            if check is not None:
+                check()
+            scores = queries @ self.encodings[start:start+GALLERY_CHUNK_SIZE].T
+            for q, row in enumerate(scores):
+                inds = np.where(row >= threshold)[0]
+                matched_inds[q].append(inds + start)
+                matched_scores[q].append(row[inds])
+        results = []
+        for q in range(len(queries)):
+            if len(matched_inds[q]) == 0:
+                results.append([])
+                continue
+            inds = np.concatenate(matched_inds[q])
+            scores = np.concatenate(matched_scores[q])
+            inds = inds[np.argsort(scores)[::-1]]
+            results.append(self.ids[inds].tolist())
+        return results
+
+
+_gallery = None
+_gallery_mtime = None
+
+def _source_mtime():
+    '''
+    Returns: modification times of the sources gallery is read from, the
+            store (None if there is none) and the person json directory.
+    '''
+    store_mtime = None
+    if EmbeddingStore.exists(EMBEDDING_STORE_PATH):
+        store_mtime = EmbeddingStore.mtime(EMBEDDING_STORE_PATH)
+    return store_mtime, os.stat(PERSON_DATA_PATH).st_mtime_ns
+
+
+def get_gallery():
+    '''
+    Returns: Gallery of the current process. It is read from EMBEDDING_STORE_PATH
+            if a store exists there else from PERSON_DATA_PATH. Persons enrolled
+            as json files after the store was built are appended to it first.
+            It is loaded once and reloaded only when its sources change. If
+            USE_ANN_INDEX is set the index at ANN_INDEX_PATH is attached to it,
+            else if GALLERY_COMPRESSION is set the codes at COMPRESSED_GALLERY_PATH are.
+    '''
+    global _gallery, _gallery_mtime
+    mtime = _source_mtime()
+    if _gallery is None or mtime != _gallery_mtime:
+        store_mtime, person_data_mtime = mtime
+        if store_mtime is not None:
+            if _gallery_mtime is None or person_data_mtime != _gallery_mtime[1]:
+                sync_person_data(PERSON_DATA_PATH, EMBEDDING_STORE_PATH)
+                # Directory mtime read before the sync, files added during
+                # it are picked up by the next call.
+                mtime = (_source_mtime()[0], person_data_mtime)
+            _gallery = Gallery.from_store(EMBEDDING_STORE_PATH)
+        else:
+            _gallery = Gallery.from_person_data(PERSON_DATA_PATH)
+        _gallery_mtime = mtime
+        if USE_ANN_INDEX and os.path.exists(ANN_INDEX_PATH):
+            _gallery.attach_index(IVFIndex.load(ANN_INDEX_PATH, _gallery.encodings))
+        elif GALLERY_COMPRESSION is not None and os.path.exists(COMPRESSED_GALLERY_PATH):
+            _gallery.attach_index(CompressedIndex.load(COMPRESSED_GALLERY_PATH, _gallery.encodings))
+    return _gallery
+
+
+_starred_ids = None
+_starred_ids_time = None
+
+def get_starred_ids():
+    '''
+    Returns: sorted tuple of ids of at most STARRED_PERSON_COUNT_LIMIT starred
+            persons. They are read from database at most once per
+            STARRED_PERSONS_TTL seconds, so a star change is seen by every
+            process within that time.
+    '''
+    global _starred_ids, _starred_ids_time
+    now = time.monotonic()
+    if _starred_ids is None or now - _starred_ids_time >= STARRED_PERSONS_TTL:
+        persons = get_starred_persons()[:STARRED_PERSON_COUNT_LIMIT]
+        _starred_ids = tuple(sorted(pid for pid, _ in persons))
+        _starred_ids_time = now
+    return _starred_ids
+
+
+_starred_gallery = None
+_starred_key = None
+
+def get_starred_gallery():
+    '''
+    Returns: small Gallery of starred persons of the current process, resident
+            in memory. It is rebuilt only when starred persons or the gallery change.
+    '''
+    global _starred_gallery, _starred_key
+    gallery = get_gallery()
+    key = (_gallery_mtime, len(gallery), get_starred_ids())
+    if _starred_gallery is None or key != _starred_key:
+        _starred_gallery = gallery.subset(key[2])
+        _starred_key = key
+    return _starred_gallery
@@ -0,0 +1,22 @@
+import os
+
+# Imported by every inference worker before its initializer runs, so it must
+# stay free of import time side effects. Models are loaded by init_worker.
+
+def init_worker(num_threads, ready_queue, embedding_cache=None):
+    '''
+    num_threads: number of intra-op threads of torch in this worker.
+    ready_queue: queue to which pid of worker is put once models are loaded.
+    embedding_cache: proxy of LRUCache shared by all workers or None to 
+                    keep a cache per worker.
+    Initializer of inference pool, loads detector, encoder and gallery
+    once per worker.
+    '''
+    import torch
+    torch.set_num_threads(num_threads)
+    # Importing model_utils loads detector and encoder weights.
+    import model_utils
+    model_utils.get_gallery()
+    if embedding_cache is not None:
+        model_utils.set_embedding_cache(embedding_cache)
+    ready_queue.put(os.getpid())
@@ -1,16 +1,41 @@
 import os
-import json
 import time
+import queue
+import threading
 import numpy as np
 
 from face_encoder.encoder import encode_face as ef
+from face_encoder.encoder import encode_faces as efs
 from face_detector.detector import detect_faces as dfs
+from face_detector.detector import detect_faces_batch as dfsb
+from face_detector.detector import detect_faces_tiled as dfst
+from gallery import get_gallery, get_starred_gallery
+from cache_utils import LRUCache
+from batch_scheduler import BatchScheduler
 from config import (
     FACE_MATCH_THRESHOLD, 
     FACE_IMAGE_PATH, 
-    PERSON_DATA_PATH
+    PERSON_DATA_PATH, 
+    TILED_DETECTION_MIN_PIXELS, 
+    TILED_DETECTION_WORKERS, 
+    EMBEDDING_CACHE_MAX_BYTES, 
+    PIPELINE_ENCODE_BATCH_SIZE, 
+    SEARCH_BLOCK_SIZE, 
+    USE_BATCH_SCHEDULER, 
+    DETECT_SCHEDULER_BATCH_SIZE, 
+    ENCODE_SCHEDULER_BATCH_SIZE, 
+    SCHEDULER_MAX_WAIT_MS, 
+    ESTIMATED_FACES_PER_IMAGE
 )
 
+# Face encodings keyed by (image content hash, bbox). Inference workers replace it 
+# with a proxy of one cache shared by all workers through set_embedding_cache.
+embedding_cache = LRUCache(EMBEDDING_CACHE_MAX_BYTES)
+
+# Batch schedulers keyed by (name, pid) as forked processes do not inherit their threads.
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
 def encode_face(img):
     '''
     img: numpy array of shape HxWx3 and data type uint8.
@@ -19,6 +44,14 @@ def encode_face(img):
     return ef(img)
 
 
+def encode_faces(imgs):
+    '''
+    imgs: list of numpy arrays of shape HxWx3 and data type uint8.
+    Returns: numpy array of shape NxD holding encoding of every face.
+    '''
+    return efs(imgs)
+
+
 def encodings_cosine(enc1, enc2):
     '''
     enc1: encoding of first face (np.array).
@@ -35,11 +68,72 @@ def encodings_cosine(enc1, enc2):
 def detect_faces(img):
     '''
     img: numpy array of shape HxWx3 and data type uint8.
+    Images larger than TILED_DETECTION_MIN_PIXELS are detected tile by tile.
     Returns a list of bounding boxes of format (x1, y1, x2, y2).
     '''
+    if img.shape[0]*img.shape[1] > TILED_DETECTION_MIN_PIXELS:
+        return dfst(img, workers=TILED_DETECTION_WORKERS)
     return dfs(img)
 
 
+def detect_faces_batch(imgs):
+    '''
+    imgs: list of numpy arrays of shape HxWx3 and data type uint8.
+    Returns: list holding list of bounding boxes of format (x1, y1, x2, y2) for every image.
+    '''
+    return dfsb(imgs)
+
+
+def get_scheduler(name):
+    '''
+    name: "detect" or "encode".
+    Returns: BatchScheduler of name owned by current process.
+    '''
+    key = (name, os.getpid())
+    with _schedulers_lock:
+        if key not in _schedulers:
+            if name == "detect":
+                _schedulers[key] = BatchScheduler(dfsb, DETECT_SCHEDULER_BATCH_SIZE, SCHEDULER_MAX_WAIT_MS)
+            else:
+                _schedulers[key] = BatchScheduler(lambda imgs: list(efs(imgs)), ENCODE_SCHEDULER_BATCH_SIZE, SCHEDULER_MAX_WAIT_MS)
+        return _schedulers[key]
+
+
+def detect_faces_scheduled(img):
+    '''
+    img: numpy array of shape HxWx3 and data type uint8.
+    Detects faces in a batch together with images of concurrent requests 
+    when USE_BATCH_SCHEDULER is set.
+    Returns a list of bounding boxes of format (x1, y1, x2, y2).
+    '''
+    if not USE_BATCH_SCHEDULER or img.shape[0]*img.shape[1] > TILED_DETECTION_MIN_PIXELS:
+        return detect_faces(img)
+    return get_scheduler("detect").submit(img).result()
+
+
+def encode_faces_scheduled(imgs):
+    '''
+    imgs: list of numpy arrays of shape HxWx3 and data type uint8.
+    Encodes faces in batches together with faces of concurrent requests 
+    when USE_BATCH_SCHEDULER is set.
+    Returns: numpy array of shape NxD holding encoding of every face.
+    '''
+    if not USE_BATCH_SCHEDULER or len(imgs) == 0:
+        return encode_faces(imgs)
+    scheduler = get_scheduler("encode")
+    futures = [scheduler.submit(img) for img in imgs]
+    return np.stack([future.result() for future in futures])
+
+
+def estimate_task_cost(bboxes=None):
+    '''
+    bboxes: list of bounding boxes to be searched or None if they are not detected yet.
+    Returns: estimated cost of searching bboxes, number of faces. Gallery size is 
+            same for every task, so it is left out of the estimate.
+    '''
+    return ESTIMATED_FACES_PER_IMAGE if bboxes is None else len(bboxes)
+
+
 def crop_face(img, bbox):
     '''
     img: numpy array of shape HxWx3 and data type uint8.
@@ -51,48 +145,192 @@ def crop_face(img, bbox):
     return face
 
 
-def search_matching_faces(img, bboxes, token, progress_dict):
+def encode_faces_cached(img, bboxes, image_hash=None):
     '''
     img: numpy array of shape HxWx3 and data type uint8.
     bboxes: list of bounding boxes of format (x1, y1, x2, y2).
-    token: unique token to track progress of task and get result.
-    progress_dict: progress_dict mapped to token as key and task progress as value.
+    image_hash: content hash of image, encodings are not cached if None.
+    Only faces whose encoding is not in embedding_cache are encoded, in batches 
+    shared with concurrent callers in same process through encode_faces_scheduled.
+    Returns: numpy array of shape NxD holding encoding of every bbox.
+    '''
+    if image_hash is None:
+        return encode_faces_scheduled([crop_face(img, bbox) for bbox in bboxes])
+    keys = [(image_hash, tuple(bbox)) for bbox in bboxes]
+    cached = embedding_cache.get_many(keys)
+    missing = [i for i, encoding in enumerate(cached) if encoding is None]
+    if missing:
+        encodings = encode_faces_scheduled([crop_face(img, bboxes[i]) for i in missing])
+        for i, encoding in zip(missing, encodings):
+            cached[i] = encoding
+        embedding_cache.put_many([(keys[i], cached[i], cached[i].nbytes) for i in missing])
+    return np.stack(cached) if cached else np.zeros((0, 0), dtype=np.float32)
+
+
+def set_embedding_cache(cache):
+    '''
+    cache: LRUCache or proxy of LRUCache used by encode_faces_cached.
+    '''
+    global embedding_cache
+    embedding_cache = cache
+
+
+def search_starred_faces(bboxes, face_encodings):
+    '''
+    bboxes: list of bounding boxes of format (x1, y1, x2, y2).
+    face_encodings: numpy array of shape NxD holding encoding of every bbox.
+    Returns: list of matched starred person ids corresponding to each bbox.
+    '''
+    if len(bboxes) == 0:
+        return []
+    matches = get_starred_gallery().search(face_encodings, FACE_MATCH_THRESHOLD)
+    return [{"bbox": bbox, "matched_faces": matched_faces} for bbox, matched_faces in zip(bboxes, matches)]
+
+
+def search_matching_faces(img, bboxes, progress, image_hash=None, partial=None, starred_first=False):
+    '''
+    img: numpy array of shape HxWx3 and data type uint8.
+    bboxes: list of bounding boxes of format (x1, y1, x2, y2).
+    progress: ProgressHandle to which number of searched bboxes is reported. 
+            Task stops with TaskCancelled between blocks and gallery chunks once cancelled.
+    image_hash: content hash of image used to reuse encodings of earlier searches.
+    partial: PartialResult to which starred matches and results of every 
+            searched block are published.
+    starred_first: search starred persons first and publish their matches 
+                    found so far as partial result after every encoded 
+                    mini-batch, before searching whole gallery.
     Returns: list of matched face id corresponding to each bbox.
     '''
     results = []
-    prev_progress = 0.0
-    person_data_list = os.listdir(PERSON_DATA_PATH)
-    num_persons = len(person_data_list)
+    gallery = get_gallery()
+    num_bboxes = len(bboxes)
+    progress.start(num_bboxes)
+    if starred_first and partial is not None:
+        # Faces are encoded in mini-batches so that starred matches are 
+        # published without waiting for every face to be encoded.
+        starred_results = []
+        face_encodings = []
+        for start in range(0, num_bboxes, PIPELINE_ENCODE_BATCH_SIZE):
+            progress.check()
+            batch = bboxes[start:start+PIPELINE_ENCODE_BATCH_SIZE]
+            batch_encodings = encode_faces_cached(img, batch, image_hash)
+            starred_results += search_starred_faces(batch, batch_encodings)
+            partial.publish(starred_results)
+            face_encodings.append(batch_encodings)
+        if not face_encodings:
+            partial.publish(starred_results)
+        face_encodings = np.concatenate(face_encodings) if face_encodings else np.zeros((0, 0), dtype=np.float32)
+        blocks = (
+            (start, face_encodings[start:start+SEARCH_BLOCK_SIZE]) 
+            for start in range(0, num_bboxes, SEARCH_BLOCK_SIZE)
+        )
+    else:
+        # Faces are encoded block by block, so a cancelled task stops between blocks.
+        blocks = _encode_batches(img, bboxes, image_hash, SEARCH_BLOCK_SIZE, progress.check)
+    # Bboxes are searched in blocks so that gallery is scanned once per block.
+    for start, block_encodings in blocks:
+        progress.check()
+        block = bboxes[start:start+len(block_encodings)]
+        matches = gallery.search(block_encodings, FACE_MATCH_THRESHOLD, check=progress.check)
+        block_results = [
+            {"bbox": bbox, "matched_faces": matched_faces} 
+            for bbox, matched_faces in zip(block, matches)
+        ]
+        results += block_results
+        if partial is not None:
+            partial.append_bboxes(block_results)
+        progress.update(len(results))
+    progress.finish()
+    return results
+
+
+def _encode_batches(img, bboxes, image_hash, batch_size, check):
+    '''
+    Encodes bboxes in mini-batches of batch_size and yields (start, encodings) 
+    of every batch. check is called before every batch.
+    '''
+    for start in range(0, len(bboxes), batch_size):
+        check()
+        yield start, encode_faces_cached(img, bboxes[start:start+batch_size], image_hash)
+
+
+def _encode_stage(img, bboxes, image_hash, batch_size, out_queue, check):
+    '''
+    Puts (start, encodings) of every batch of _encode_batches in out_queue 
+    followed by None. An exception is put in out_queue in place of a batch.
+    '''
+    try:
+        for batch in _encode_batches(img, bboxes, image_hash, batch_size, check):
+            out_queue.put(batch)
+        out_queue.put(None)
+    except Exception as e:
+        out_queue.put(e)
+
+
+def _drain_batches(out_queue):
+    '''
+    Yields batches put in out_queue by _encode_stage and raises its exception.
+    '''
+    while True:
+        batch = out_queue.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+
+
+def identify_faces(img, progress, image_hash=None, bboxes=None, overlapped=False, partial=None, starred_first=False):
+    '''
+    img: numpy array of shape HxWx3 and data type uint8.
+    progress: ProgressHandle to which number of searched bboxes is reported. 
+            Task stops with TaskCancelled between stages once cancelled.
+    image_hash: content hash of image used to reuse encodings of earlier searches.
+    bboxes: list of bounding boxes of format (x1, y1, x2, y2), detected if None.
+    overlapped: encode faces in mini-batches in a separate thread while 
+                earlier batches are searched in gallery.
+    partial: PartialResult to which starred matches and results of every 
+            searched batch are published.
+    starred_first: search every encoded batch in starred persons first and 
+                    publish starred matches found so far as partial result.
+    Detects faces, encodes them and searches them in gallery in one task.
+    Returns: list of matched face id corresponding to each bbox.
+    '''
+    progress.check()
+    if bboxes is None:
+        bboxes = detect_faces(img)
+    gallery = get_gallery()
     num_bboxes = len(bboxes)
-    for i in range(num_bboxes):
-        bbox = bboxes[i]
-        face = crop_face(img, bbox)
-        face_encoding = encode_face(face)
-        matched_faces = []
-        cosine_dists = []
-        result = {
-            "bbox": bbox, 
-            "matched_faces": []
-        }
-        for j in range(num_persons):
-            person_data = os.path.join(PERSON_DATA_PATH, person_data_list[j])
-            with open(person_data, "r") as f:
-                person_data = json.loads(f.read())
-            person_id = person_data["id"]
-            person_face_encoding = np.array(person_data["face_encoding"])
-            cosine = encodings_cosine(face_encoding, person_face_encoding)
-            if cosine >= FACE_MATCH_THRESHOLD:
-                matched_faces.append(person_id)
-                cosine_dists.append(cosine)
-            new_progress = ((i+1)*(j+1))/(num_bboxes*num_persons)
-            if(new_progress - prev_progress >= 0.01):
-                progress_dict[token] = new_progress
-                prev_progress = new_progress
-        sorted_indices = np.argsort(cosine_dists)[::-1]
-        sorted_matched_faces = matched_faces.copy()
-        for ind in range(len(matched_faces)):
-            sorted_matched_faces[ind] = matched_faces[sorted_indices[ind]]
-        result["matched_faces"] = sorted_matched_faces
-        results.append(result)
-    progress_dict[token] = 1.0
+    progress.start(num_bboxes)
+    results = [None]*num_bboxes
+    starred_results = []
+    if not overlapped:
+        # Small batches so that results and progress are published during search.
+        batches = _encode_batches(img, bboxes, image_hash, SEARCH_BLOCK_SIZE, progress.check)
+    else:
+        out_queue = queue.Queue()
+        encoder = threading.Thread(
+            target=_encode_stage, 
+            args=(img, bboxes, image_hash, PIPELINE_ENCODE_BATCH_SIZE, out_queue, progress.check), 
+            daemon=True
+        )
+        encoder.start()
+        batches = _drain_batches(out_queue)
+    done = 0
+    for start, face_encodings in batches:
+        if starred_first and partial is not None:
+            starred_results += search_starred_faces(bboxes[start:start+len(face_encodings)], face_encodings)
+            partial.publish(starred_results)
+        matches = gallery.search(face_encodings, FACE_MATCH_THRESHOLD, check=progress.check)
+        for i, matched_faces in enumerate(matches):
+            results[start+i] = {
+                "bbox": bboxes[start+i], 
+                "matched_faces": matched_faces
+            }
+        # Batches arrive in bbox order, so appended results stay in bbox order.
+        if partial is not None:
+            partial.append_bboxes(results[start:start+len(matches)])
+        done += len(matches)
+        progress.update(done)
+    progress.finish()
     return results
@@ -0,0 +1,257 @@
+import time
+import threading
+import numpy as np
+from multiprocessing import shared_memory
+
+from config import PROGRESS_TABLE_SLOTS
+
+STATE_FREE = 0
+STATE_QUEUED = 1
+STATE_RUNNING = 2
+STATE_COMPLETED = 3
+
+SLOT_DTYPE = np.dtype([
+    ("ticket", np.int64),
+    ("state", np.int64),
+    ("done", np.float64),
+    ("total", np.float64),
+    ("start", np.float64),
+    ("end", np.float64),
+    ("partial", np.int64),
+    ("cancelled", np.int64)
+])
+
+class TaskCancelled(Exception):
+    '''
+    Raised in a worker when its task has been cancelled.
+    '''
+    pass
+
+
+# Shared memory blocks attached by this process, keyed by name.
+_attached = {}
+_attached_lock = threading.Lock()
+
+def _attach(name, num_slots):
+    '''
+    Returns: slot array of shared memory block name, attached once per process.
+    '''
+    with _attached_lock:
+        if name not in _attached:
+            # Workers inherit resource tracker of server as progress table is 
+            # created before pool, so block is not unlinked when a worker exits.
+            shm = shared_memory.SharedMemory(name=name)
+            _attached[name] = (shm, np.ndarray(num_slots, dtype=SLOT_DTYPE, buffer=shm.buf))
+        return _attached[name][1]
+
+
+class ProgressHandle(object):
+    '''
+    Picklable handle through which a worker reports progress of its task
+    into one slot of a ProgressTable. Every field of a slot has a single 
+    writer, the worker or the server for cancelled, so updates take no lock 
+    and never overwrite each other.
+    '''
+    def __init__(self, name, num_slots, slot, ticket):
+        self.name = name
+        self.num_slots = num_slots
+        self.slot = slot
+        self.ticket = ticket
+
+    def _row(self):
+        row = _attach(self.name, self.num_slots)[self.slot:self.slot+1]
+        # Slot has been freed and reused by another task.
+        if row["ticket"][0] != self.ticket:
+            return None
+        return row
+
+    def cancelled(self):
+        '''
+        Returns: True if task has been cancelled or its slot has been freed.
+        '''
+        row = self._row()
+        return row is None or row["cancelled"][0] != 0
+
+    def check(self):
+        '''
+        Raises TaskCancelled if task has been cancelled. Workers call it 
+        between units of work to stop cooperatively.
+        '''
+        if self.cancelled():
+            raise TaskCancelled()
+
+    def start(self, total):
+        '''
+        total: number of work items of task.
+        Raises TaskCancelled if task has been cancelled.
+        '''
+        row = self._row()
+        if row is not None:
+            row["done"] = 0
+            row["total"] = total
+            row["start"] = time.time()
+            row["state"] = STATE_RUNNING
+        self.check()
+
+    def update(self, done):
+        '''
+        done: number of work items completed so far.
+        '''
+        row = self._row()
+        if row is not None:
+            row["done"] = done
+
+    def mark_partial(self):
+        '''
+        Counts a new partial result published by task.
+        '''
+        row = self._row()
+        if row is not None:
+            row["partial"] += 1
+
+    def finish(self):
+        row = self._row()
+        if row is not None:
+            row["done"] = row["total"]
+            row["end"] = time.time()
+            row["state"] = STATE_COMPLETED
+
+
+class ProgressTable(object):
+    '''
+    Fixed number of task progress slots in shared memory. Workers write
+    their slot through a ProgressHandle and the server reads all slots
+    as local memory without any IPC.
+    '''
+    def __init__(self, num_slots=PROGRESS_TABLE_SLOTS):
+        '''
+        num_slots: maximum number of tasks tracked at once.
+        '''
+        self.num_slots = num_slots
+        self._shm = shared_memory.SharedMemory(create=True, size=num_slots*SLOT_DTYPE.itemsize)
+        self.slots = np.ndarray(num_slots, dtype=SLOT_DTYPE, buffer=self._shm.buf)
+        self.slots[:] = 0
+        self._tokens = {}
+        self._next_ticket = 1
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __contains__(self, token):
+        return token in self._tokens
+
+    def allocate(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: ProgressHandle of a free slot or None if all slots are in use.
+        '''
+        with self._lock:
+            free = np.where(self.slots["state"] == STATE_FREE)[0]
+            if len(free) == 0:
+                return None
+            slot = int(free[0])
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self.slots[slot] = (ticket, STATE_QUEUED, 0, 0, time.time(), 0, 0, 0)
+            self._tokens[token] = slot
+            return ProgressHandle(self._shm.name, self.num_slots, slot, ticket)
+
+    def free(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: True if slot of token is freed else False.
+        '''
+        with self._lock:
+            slot = self._tokens.pop(token, None)
+            if slot is None:
+                return False
+            self.slots[slot] = 0
+            return True
+
+    def cancel(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Flags task as cancelled, its worker stops at its next check. A task 
+        completing concurrently stays cancelled and its result is not returned.
+        Returns: True if task is cancelled, False if it is already completed 
+                or None if token is not valid.
+        '''
+        with self._lock:
+            slot = self._tokens.get(token)
+            if slot is None:
+                return None
+            if self.slots["state"][slot] == STATE_COMPLETED and not self.slots["cancelled"][slot]:
+                return False
+            self.slots["cancelled"][slot] = 1
+            return True
+
+    def is_cancelled(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: True if task of token has been cancelled.
+        '''
+        slot = self._slot(token)
+        return slot is not None and slot["cancelled"] != 0
+
+    def _slot(self, token):
+        slot = self._tokens.get(token)
+        return None if slot is None else self.slots[slot]
+
+    def get_progress(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: float value representing the progress of task in [0, 1]
+                or None if token is not valid.
+        '''
+        slot = self._slot(token)
+        if slot is None:
+            return None
+        if slot["state"] == STATE_COMPLETED:
+            return 1.0
+        if slot["total"] == 0:
+            return 0.0
+        return float(slot["done"]/slot["total"])
+
+    def get_eta(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: estimated seconds until task is completed, 0.0 if completed,
+                None if not enough progress has been made or token is not valid.
+        '''
+        slot = self._slot(token)
+        if slot is None:
+            return None
+        if slot["state"] == STATE_COMPLETED:
+            return 0.0
+        if slot["state"] != STATE_RUNNING or slot["done"] == 0:
+            return None
+        elapsed = time.time() - slot["start"]
+        return float(elapsed*(slot["total"] - slot["done"])/slot["done"])
+
+    def get_done(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: number of work items completed so far or None if token is not valid.
+        '''
+        slot = self._slot(token)
+        return None if slot is None else int(slot["done"])
+
+    def partial_count(self, token):
+        '''
+        token: unique process token generated when creating process.
+        Returns: number of partial results published by task or None if token is not valid.
+        '''
+        slot = self._slot(token)
+        return None if slot is None else int(slot["partial"])
+
+    def counts(self):
+        '''
+        Returns: A tuple of (total_tasks, completed_tasks) of allocated slots.
+        '''
+        states = self.slots["state"]
+        return (int(np.count_nonzero(states != STATE_FREE)), int(np.count_nonzero(states == STATE_COMPLETED)))
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
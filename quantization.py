@@ -0,0 +1,292 @@
+import argparse
+import numpy as np
+
+from embedding_store import l2_normalize
+from config import (
+    FACE_MATCH_THRESHOLD,
+    GALLERY_CHUNK_SIZE,
+    GALLERY_COMPRESSION,
+    COMPRESSED_GALLERY_PATH,
+    PQ_SUBSPACES,
+    PQ_RESCORE_MARGIN
+)
+
+class ScalarQuantizer(object):
+    '''
+    Symmetric per-dimension int8 quantisation of encodings.
+    Dimension i is stored as round(x_i/scale_i) in [-127, 127].
+    '''
+    def __init__(self, scale):
+        '''
+        scale: array of D per-dimension scales.
+        '''
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @classmethod
+    def train(cls, encodings):
+        '''
+        encodings: numpy array of shape NxD of L2-normalised encodings.
+        Returns: ScalarQuantizer covering the range of every dimension.
+        '''
+        scale = np.zeros(encodings.shape[1], dtype=np.float32)
+        for start in range(0, len(encodings), GALLERY_CHUNK_SIZE):
+            chunk = np.abs(encodings[start:start+GALLERY_CHUNK_SIZE])
+            scale = np.maximum(scale, chunk.max(axis=0))
+        scale = scale/127.0
+        scale[scale == 0] = 1.0
+        return cls(scale)
+
+    def encode(self, encodings):
+        '''
+        Returns: NxD int8 codes of encodings.
+        '''
+        return np.clip(np.rint(encodings/self.scale), -127, 127).astype(np.int8)
+
+    def scores(self, queries, codes):
+        '''
+        queries: QxD L2-normalised query encodings.
+        codes: NxD int8 codes.
+        Returns: (QxN approximate cosine similarities of queries with codes,
+                QxN upper bound on absolute error of those similarities).
+        '''
+        scaled_queries = queries*self.scale
+        # Rounding error of every dimension is at most scale_i/2.
+        bound = 0.5*np.abs(scaled_queries).sum(axis=1, keepdims=True)
+        approx = scaled_queries @ codes.astype(np.float32).T
+        return approx, np.broadcast_to(bound, approx.shape)
+
+    def state(self):
+        return {"scale": self.scale}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state["scale"])
+
+
+def _kmeans_l2(x, k, iterations, rng):
+    '''
+    Returns: KxD centroids of x found with euclidean Lloyd iterations.
+    '''
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(iterations):
+        dists = (centroids**2).sum(axis=1) - 2*(x @ centroids.T)
+        assignment = dists.argmin(axis=1)
+        order = np.argsort(assignment, kind="stable")
+        counts = np.bincount(assignment, minlength=k)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        nonempty = np.where(counts > 0)[0]
+        sums = np.add.reduceat(x[order], starts[nonempty], axis=0)
+        centroids[nonempty] = sums/counts[nonempty, np.newaxis]
+    return centroids
+
+
+class ProductQuantizer(object):
+    '''
+    Product quantisation of encodings. Encoding is split in m sub-vectors,
+    each sub-vector is replaced by the index of its nearest of 256 centroids.
+    Similarities are computed with asymmetric distance tables, the query is
+    never quantised.
+    '''
+    def __init__(self, codebooks, rescore_margin=PQ_RESCORE_MARGIN):
+        '''
+        codebooks: numpy array of shape m x 256 x D/m.
+        rescore_margin: cap of error bound of similarities or None for the strict 
+                        residual norm bound. A cap rescores fewer candidates but 
+                        may miss matches above threshold.
+        '''
+        self.codebooks = np.asarray(codebooks, dtype=np.float32)
+        self.rescore_margin = rescore_margin
+        self._offsets = np.arange(self.m)*256
+
+    @property
+    def m(self):
+        return self.codebooks.shape[0]
+
+    @classmethod
+    def train(cls, encodings, m=PQ_SUBSPACES, iterations=20, max_train_size=65536, seed=0):
+        '''
+        encodings: numpy array of shape NxD of L2-normalised encodings.
+        m: number of sub-vectors, D must be divisible by m.
+        iterations: number of k-means iterations per sub-space.
+        max_train_size: number of encodings sampled for training.
+        seed: seed of random generator.
+        Returns: trained ProductQuantizer.
+        '''
+        dim = encodings.shape[1]
+        if dim % m != 0:
+            raise ValueError("dimension {} is not divisible by {} sub-vectors".format(dim, m))
+        rng = np.random.default_rng(seed)
+        train = encodings
+        if len(encodings) > max_train_size:
+            train = encodings[np.sort(rng.choice(len(encodings), max_train_size, replace=False))]
+        train = np.asarray(train, dtype=np.float32)
+        dsub = dim//m
+        codebooks = np.stack([
+            _kmeans_l2(train[:, j*dsub:(j+1)*dsub], 256, iterations, rng) for j in range(m)
+        ])
+        return cls(codebooks)
+
+    def encode(self, encodings):
+        '''
+        Returns: Nxm uint8 codes of encodings followed by a float16 column
+                pair holding the norm of the reconstruction residual.
+        '''
+        dsub = self.codebooks.shape[2]
+        codes = np.empty((len(encodings), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            sub = encodings[:, j*dsub:(j+1)*dsub]
+            dists = (self.codebooks[j]**2).sum(axis=1) - 2*(sub @ self.codebooks[j].T)
+            codes[:, j] = dists.argmin(axis=1)
+        residual = np.linalg.norm(encodings - self.decode(codes), axis=1)
+        # Round residual norm up so that it stays an upper bound after casting.
+        residual = np.nextafter(residual.astype(np.float16), np.float16(np.inf))
+        return np.concatenate([codes, residual[:, np.newaxis].view(np.uint8)], axis=1)
+
+    def decode(self, codes):
+        '''
+        Returns: NxD reconstruction of codes.
+        '''
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.m)], axis=1)
+
+    def scores(self, queries, codes):
+        '''
+        queries: QxD L2-normalised query encodings.
+        codes: Nx(m+2) codes returned by encode().
+        Returns: (QxN approximate cosine similarities of queries with codes,
+                QxN upper bound on absolute error of those similarities).
+        '''
+        dsub = self.codebooks.shape[2]
+        # tables[q, j, c] is dot product of j-th sub-vector of query q with centroid c.
+        tables = np.einsum("jcd,qjd->qjc", self.codebooks, queries.reshape(len(queries), self.m, dsub))
+        inds = codes[:, :self.m].astype(np.intp) + self._offsets
+        approx = np.stack([table.ravel()[inds].sum(axis=1) for table in tables])
+        # By Cauchy-Schwarz a unit query differs from its approximate similarity
+        # by at most the residual norm. Capping it by margin is opt-in as it drops matches.
+        bound = np.ascontiguousarray(codes[:, self.m:]).view(np.float16)[:, 0].astype(np.float32)
+        if self.rescore_margin is not None:
+            bound = np.minimum(bound, self.rescore_margin)
+        return approx, np.broadcast_to(bound, approx.shape)
+
+    def state(self):
+        return {"codebooks": self.codebooks}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state["codebooks"])
+
+
+QUANTIZERS = {
+    "int8": ScalarQuantizer,
+    "pq": ProductQuantizer
+}
+
+
+class CompressedIndex(object):
+    '''
+    Gallery index holding only quantised codes in memory. Candidates whose
+    approximate similarity may reach threshold are rescored with the full
+    precision encodings, which are usually memory-mapped from EmbeddingStore,
+    so matching decisions are made on exact similarities.
+    '''
+    def __init__(self, mode, quantizer, ids, codes, encodings=None):
+        '''
+        mode: one of keys of QUANTIZERS.
+        quantizer: trained quantizer of mode.
+        ids: array of N person ids.
+        codes: codes of N encodings.
+        encodings: NxD full precision encodings used for rescoring.
+        '''
+        self.mode = mode
+        self.quantizer = quantizer
+        self.ids = np.asarray(ids, dtype=object)
+        self.codes = codes
+        self.encodings = encodings
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids, encodings, mode=GALLERY_COMPRESSION):
+        '''
+        ids: list of N person ids.
+        encodings: numpy array of shape NxD of L2-normalised encodings.
+        mode: "int8" or "pq".
+        Returns: CompressedIndex of encodings.
+        '''
+        quantizer = QUANTIZERS[mode].train(encodings)
+        codes = np.concatenate([
+            quantizer.encode(np.asarray(encodings[start:start+GALLERY_CHUNK_SIZE], dtype=np.float32))
+            for start in range(0, len(encodings), GALLERY_CHUNK_SIZE)
+        ])
+        return cls(mode, quantizer, ids, codes, encodings)
+
+    def search(self, encodings, threshold=FACE_MATCH_THRESHOLD, check=None):
+        '''
+        encodings: numpy array of shape D or QxD of query face encodings.
+        threshold: minimum cosine similarity for a person to be matched.
+        check: function called between chunks which raises to stop search.
+        Returns: list of Q lists of matched person ids sorted by decreasing similarity.
+        '''
+        if self.encodings is None:
+            raise ValueError("full precision encodings are required for rescoring")
+        queries = l2_normalize(encodings).reshape(len(np.atleast_2d(encodings)), -1)
+        matched_rows = [[np.zeros(0, dtype=np.int64)] for _ in range(len(queries))]
+        matched_scores = [[np.zeros(0, dtype=np.float32)] for _ in range(len(queries))]
+        for start in range(0, len(self), GALLERY_CHUNK_SIZE):
+            if check is not None:
+                check()
+            approx, bound = self.quantizer.scores(queries, self.codes[start:start+GALLERY_CHUNK_SIZE])
+            # Candidates are rescored chunk by chunk so that only full precision 
+            # rows of one chunk are held in memory at a time.
+            rows = np.where((approx >= threshold - bound).any(axis=0))[0] + start
+            if len(rows) == 0:
+                continue
+            scores = queries @ np.asarray(self.encodings[rows], dtype=np.float32).T
+            for q, row in enumerate(scores):
+                inds = np.where(row >= threshold)[0]
+                matched_rows[q].append(rows[inds])
+                matched_scores[q].append(row[inds])
+        results = []
+        for rows, scores in zip(matched_rows, matched_scores):
+            rows = np.concatenate(rows)
+            scores = np.concatenate(scores)
+            order = np.argsort(scores)[::-1]
+            results.append(self.ids[rows[order]].tolist())
+        return results
+
+    def nbytes(self):
+        '''
+        Returns: number of bytes held in memory by codes and quantizer.
+        '''
+        return self.codes.nbytes + sum(v.nbytes for v in self.quantizer.state().values())
+
+    def save(self, path):
+        '''
+        path: .npz file to which codes and quantizer are written.
+        '''
+        np.savez(path, mode=self.mode, ids=self.ids.astype(str), codes=self.codes, **self.quantizer.state())
+
+    @classmethod
+    def load(cls, path, encodings):
+        '''
+        path: .npz file written by save().
+        encodings: NxD full precision encodings used for rescoring.
+        Returns: CompressedIndex instance.
+        '''
+        with np.load(path) as data:
+            mode = str(data["mode"])
+            quantizer = QUANTIZERS[mode].from_state(data)
+            return cls(mode, quantizer, data["ids"].astype(object), data["codes"], encodings)
+
+
+if __name__ == "__main__":
+    from gallery import get_gallery
+    parser = argparse.ArgumentParser(description="Build compressed gallery codes over current gallery")
+    parser.add_argument("--mode", default=GALLERY_COMPRESSION or "int8", choices=list(QUANTIZERS.keys()))
+    parser.add_argument("--path", default=COMPRESSED_GALLERY_PATH)
+    args = parser.parse_args()
+    gallery = get_gallery()
+    index = CompressedIndex.build(gallery.ids, gallery.encodings, args.mode)
+    index.save(args.path)
+    print("Compressed {} encodings with {} to {} ({:.1f} MB)".format(
+        len(index), args.mode, args.path, index.nbytes()/(1024*1024)))
@@ -1,5 +1,7 @@
 import os
+import io
 import uuid
+import hashlib
 import sqlite3
 from PIL import Image
 import numpy as np
@@ -9,7 +11,9 @@ import json
 
 from config import (
     PERSON_DATA_PATH, 
-    FACE_IMAGE_PATH
+    FACE_IMAGE_PATH, 
+    MAX_IMAGE_BYTES, 
+    MAX_IMAGE_PIXELS
 )
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
@@ -36,6 +40,46 @@ def read_image(img_path):
     return img
 
 
+def read_image_from_bytes(data, max_pixels=MAX_IMAGE_PIXELS):
+    '''
+    data: encoded image file contents (bytes).
+    max_pixels: maximum number of pixels of image to be decoded.
+    Returns: a numpy array of shape HxWx3 and data type uint8 
+            or None if image has more than max_pixels pixels.
+    '''
+    img = Image.open(io.BytesIO(data))
+    # Only the header has been read so far, size is checked before decoding.
+    if img.size[0]*img.size[1] > max_pixels:
+        return None
+    # Grayscale and alpha images are converted so that every image is HxWx3.
+    img = np.array(img.convert("RGB"))
+    img = img.astype(np.uint8)
+    return img
+
+
+def decode_base64(data, max_bytes=MAX_IMAGE_BYTES):
+    '''
+    data: base64 encoded data that has been decoded as UTF-8 string.
+    max_bytes: maximum size of decoded data.
+    Returns: decoded bytes or None if decoded data exceeds max_bytes.
+    '''
+    # Every 4 base64 characters carry 3 bytes.
+    if len(data)//4*3 > max_bytes + 3:
+        return None
+    data = base64.b64decode(data.encode("UTF-8"))
+    if len(data) > max_bytes:
+        return None
+    return data
+
+
+def get_content_hash(data):
+    '''
+    data: bytes.
+    Returns: hex digest of SHA-1 of data.
+    '''
+    return hashlib.sha1(data).hexdigest()
+
+
 def encode_to_base64(file_path):
     '''
     file_path: path of file whose contents are to be encoded.